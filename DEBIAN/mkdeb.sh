@@ -18,6 +18,12 @@ cp $ROOT/org.vanzin.FolderME.service usr/share/dbus-1/services
 
 mkdir -p usr/share/folderme
 cp -r $ROOT/src/* usr/share/folderme
+rm -rf usr/share/folderme/__pycache__ usr/share/folderme/ui/compiled
+
+# Ship compiled forms, so that the package does not need the uic tool at runtime.
+# This needs pyside6-uic on the build machine.
+python3 -c "import sys; sys.path.insert(0, sys.argv[1]); import util; util.precompile_ui()" \
+  usr/share/folderme || exit 1
 rm -rf usr/share/folderme/__pycache__
 
 mkdir -p usr/bin
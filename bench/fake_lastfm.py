@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# A local stand-in for the last.fm API, covering the calls made by the scrobbler.
+# Requests are checked for a valid signature, and received scrobbles are recorded.
+# Latency, server errors and rate limiting can be injected to exercise the
+# scrobbler's retry logic.
+#
+# Point the player at it with FOLDERME_LASTFM_URL=http://localhost:<port>/2.0/.
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import lastfm
+
+UNAVAILABLE_PAGE = (
+    "<html><head><title>503 Service Unavailable</title></head>\n"
+    "<body><h1>503 Service Unavailable</h1></body></html>\n"
+)
+
+
+class FakeLastFm(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0, error_rate=0, rate_limit=0, seed=None):
+        super().__init__(("127.0.0.1", port), Handler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.scrobbles = []
+        self.now_playing = []
+        self.requests = 0
+        self.errors = 0
+        self._rnd = random.Random(seed)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/2.0/"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_call(self, params):
+        """
+        Returns (HTTP status, API error code, response) for a call.
+        """
+        with self._lock:
+            self.requests += 1
+            if self.error_rate and self._rnd.random() < self.error_rate:
+                self.errors += 1
+                # Alternate between the API's own error and a front end error page.
+                if self.errors % 2:
+                    return (
+                        503,
+                        16,
+                        "There was a temporary error processing your request",
+                    )
+                return 503, None, UNAVAILABLE_PAGE
+            if self.rate_limit and self.requests % self.rate_limit == 0:
+                self.errors += 1
+                return 200, 29, "Rate limit exceeded"
+
+        sig = params.pop("api_sig", None)
+        if sig != lastfm.sign(dict(params))["api_sig"]:
+            return 403, 13, "Invalid method signature supplied"
+
+        method = params.get("method")
+        if method == "track.scrobble":
+            tracks = []
+            i = 0
+            while f"timestamp[{i}]" in params:
+                tracks.append(
+                    {
+                        k: params.get(f"{k}[{i}]")
+                        for k in ("artist", "album", "track", "timestamp")
+                    }
+                )
+                i += 1
+            if not tracks or len(tracks) > lastfm.BATCH_SIZE:
+                return 400, 6, "Invalid parameters"
+
+            with self._lock:
+                self.scrobbles.extend(tracks)
+            items = [
+                {
+                    "track": {"#text": t["track"]},
+                    "ignoredMessage": {"code": "0", "#text": ""},
+                }
+                for t in tracks
+            ]
+            return (
+                200,
+                None,
+                {
+                    "scrobbles": {
+                        "@attr": {"accepted": len(tracks), "ignored": 0},
+                        "scrobble": items if len(items) > 1 else items[0],
+                    }
+                },
+            )
+        elif method == "track.updateNowPlaying":
+            with self._lock:
+                self.now_playing.append(params.get("track"))
+            return 200, None, {"nowplaying": {"track": {"#text": params.get("track")}}}
+
+        return 400, 3, "Invalid Method"
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        query = urllib.parse.urlparse(self.path).query
+        self._handle(urllib.parse.parse_qs(query))
+
+    def do_POST(self):
+        size = int(self.headers.get("content-length", 0))
+        self._handle(urllib.parse.parse_qs(self.rfile.read(size).decode("utf-8")))
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self, query):
+        params = {k: v[0] for k, v in query.items()}
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        status, code, result = self.server.handle_call(dict(params))
+        if code is not None:
+            result = {"error": code, "message": result}
+
+        if status != 200 and code is None:
+            body = result.encode("utf-8")
+            ctype = "text/html"
+        elif params.get("format") == "json":
+            body = json.dumps(result).encode("utf-8")
+            ctype = "application/json"
+        elif code is not None:
+            body = (
+                f'<?xml version="1.0" encoding="UTF-8"?>\n<lfm status="failed">'
+                f'<error code="{code}">{result["message"]}</error></lfm>'
+            ).encode("utf-8")
+            ctype = "text/xml"
+        else:
+            body = b'<?xml version="1.0" encoding="UTF-8"?>\n<lfm status="ok"></lfm>'
+            ctype = "text/xml"
+
+        self.send_response(status)
+        self.send_header("content-type", ctype)
+        self.send_header("content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="fake last.fm API server")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0, help="seconds per call")
+    parser.add_argument("--error-rate", type=float, default=0, help="5xx fraction")
+    parser.add_argument("--rate-limit", type=int, default=0, help="fail every Nth call")
+    args = parser.parse_args(argv[1:])
+
+    server = FakeLastFm(args.port, args.latency, args.error_rate, args.rate_limit)
+    print(f"Serving on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(f"{server.requests} requests, {len(server.scrobbles)} scrobbles received")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# Watches a running player's MPRIS interface on the session bus: counts the
+# PropertiesChanged, Seeked and track list signals it sends, and measures how long
+# property reads take, while you use the player (or the UI is busy).
+#
+# To try it without touching the desktop session, run both the player and the probe
+# under a private bus, e.g.:
+#
+#   dbus-run-session -- sh -c 'src/folderme --show & sleep 5; bench/mpris_probe.py'
+import argparse
+import collections
+import sys
+import time
+
+import dbus
+from dbus.mainloop.glib import DBusGMainLoop
+from gi.repository import GLib
+
+SERVICE = "org.mpris.MediaPlayer2.folderme"
+OBJECT = "/org/mpris/MediaPlayer2"
+PLAYER_IFACE = "org.mpris.MediaPlayer2.Player"
+TRACKLIST_IFACE = "org.mpris.MediaPlayer2.TrackList"
+PROPS_IFACE = "org.freedesktop.DBus.Properties"
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="MPRIS signal and property read probe")
+    parser.add_argument("--seconds", type=float, default=30)
+    parser.add_argument(
+        "--poll-ms", type=int, default=100, help="interval between property reads"
+    )
+    parser.add_argument(
+        "--tracks", type=int, default=5, help="queued tracks to show metadata for"
+    )
+    args = parser.parse_args(argv[1:])
+
+    DBusGMainLoop(set_as_default=True)
+    bus = dbus.SessionBus()
+    player = bus.get_object(SERVICE, OBJECT)
+    props = dbus.Interface(player, PROPS_IFACE)
+
+    signals = collections.Counter()
+    values = collections.Counter()
+
+    def changed(iface, changed, invalidated):
+        signals["PropertiesChanged"] += 1
+        values.update(changed.keys())
+
+    def seeked(position):
+        signals["Seeked"] += 1
+
+    bus.add_signal_receiver(changed, "PropertiesChanged", PROPS_IFACE, SERVICE, OBJECT)
+    bus.add_signal_receiver(seeked, "Seeked", PLAYER_IFACE, SERVICE, OBJECT)
+
+    def tracklist_signal(*args, member=None):
+        signals[member] += 1
+
+    for name in ("TrackAdded", "TrackRemoved", "TrackListReplaced"):
+        bus.add_signal_receiver(
+            tracklist_signal,
+            name,
+            TRACKLIST_IFACE,
+            SERVICE,
+            OBJECT,
+            member_keyword="member",
+        )
+
+    tracks = props.Get(TRACKLIST_IFACE, "Tracks")
+    print(f"{len(tracks)} tracks queued")
+    if tracks:
+        tracklist = dbus.Interface(player, TRACKLIST_IFACE)
+        for meta in tracklist.GetTracksMetadata(tracks[: args.tracks]):
+            artist = ", ".join(meta.get("xesam:artist", []))
+            print(f"  {meta['mpris:trackid']}: {artist} - {meta.get('xesam:title')}")
+
+    reads = []
+
+    def poll():
+        start = time.perf_counter()
+        props.GetAll(PLAYER_IFACE)
+        reads.append((time.perf_counter() - start) * 1000)
+        return True
+
+    loop = GLib.MainLoop()
+    GLib.timeout_add(args.poll_ms, poll)
+    GLib.timeout_add(int(args.seconds * 1000), loop.quit)
+    print(f"Watching {SERVICE} for {args.seconds:.0f}s...")
+    loop.run()
+
+    print(f"signals: {dict(signals)}")
+    print(f"properties sent: {dict(values)}")
+    if reads:
+        print(
+            f"GetAll: n={len(reads)} p50={percentile(reads, 50):.2f}ms "
+            f"p99={percentile(reads, 99):.2f}ms max={max(reads):.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# Runs randomizer.Randomizer album selection against a synthetic collection, without
+# the UI, and reports pick throughput, latency and fairness statistics.
+import argparse
+import collections
+import os
+import random
+import sys
+import time
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import randomizer
+import util
+
+# Simulated time between picks, i.e., how long an album plays.
+ALBUM_SECS = 45 * 60
+
+
+def make_albums(rnd, count, artists, distribution):
+    if distribution == "uniform":
+        weights = [1] * artists
+    elif distribution == "zipf":
+        weights = [1 / (i + 1) for i in range(artists)]
+    else:
+        # A few prolific artists, many with a single album.
+        weights = [50 if i < artists // 100 else 1 for i in range(artists)]
+
+    names = [f"artist{i}" for i in range(artists)]
+    albums = []
+    for i in range(count):
+        artist = names[i] if i < artists else rnd.choices(names, weights)[0]
+        albums.append(
+            types.SimpleNamespace(
+                artist=artist, path=f"/music/{artist}/album{i}", tracks=()
+            )
+        )
+    return albums
+
+
+def intervals(sequence):
+    last = {}
+    result = []
+    for i, key in enumerate(sequence):
+        if key in last:
+            result.append(i - last[key])
+        last[key] = i
+    return result
+
+
+def describe(values):
+    if not values:
+        return "n/a"
+    values = sorted(values)
+    mean = sum(values) / len(values)
+    return f"min={values[0]} p1={values[len(values) // 100]} mean={mean:.0f}"
+
+
+def simulate(args, albums, bias):
+    r = randomizer.Randomizer(seed=args.seed)
+    # Start from an empty play history instead of the user's.
+    last_played = {}
+    plays = collections.Counter()
+    r._stats = types.SimpleNamespace(
+        last_played=last_played.get, plays=lambda path: plays[path]
+    )
+    latency = util.Histogram()
+    picked = []
+    now = time.time()
+
+    start = time.perf_counter()
+    for _ in range(args.picks):
+        t0 = time.perf_counter()
+        album = r.choose(albums, [], weighted=args.weighted)
+        latency.add((time.perf_counter() - t0) * 1000)
+
+        r.remember(album.artist, bias)
+        if args.weighted:
+            last_played[album.path] = now
+            plays[album.path] += 1
+            r.album_played(album, now)
+        now += ALBUM_SECS
+        picked.append(album)
+    elapsed = time.perf_counter() - start
+
+    artist_gaps = intervals([a.artist for a in picked])
+    album_gaps = intervals([id(a) for a in picked])
+    counts = collections.Counter(id(a) for a in picked)
+    expected = args.picks / len(albums)
+
+    print(f"bias {bias}:")
+    print(f"  {args.picks / elapsed:.0f} picks/sec, latency {latency}")
+    print(f"  artist repeat interval: {describe(artist_gaps)}")
+    print(f"  album repeat interval: {describe(album_gaps)}")
+    print(
+        f"  albums picked: {len(counts)}/{len(albums)}, most picked "
+        f"{max(counts.values()) / expected:.2f}x expected"
+    )
+    violations = sum(1 for gap in artist_gaps if gap <= bias)
+    print(f"  artist repeats within bias: {violations}")
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="album randomizer simulation")
+    parser.add_argument("--albums", type=int, default=20000)
+    parser.add_argument("--artists", type=int, default=3000)
+    parser.add_argument(
+        "--distribution", choices=["uniform", "zipf", "prolific"], default="zipf"
+    )
+    parser.add_argument("--bias", type=int, action="append")
+    parser.add_argument("--picks", type=int, default=1000000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--weighted", action="store_true", default=False)
+    args = parser.parse_args(argv[1:])
+
+    util.ConfigObj.SAVE_ENABLED = False
+    albums = make_albums(
+        random.Random(args.seed), args.albums, args.artists, args.distribution
+    )
+    print(
+        f"{len(albums)} albums by {len(set(a.artist for a in albums))} artists "
+        f"({args.distribution}), {args.picks} picks, seed {args.seed}"
+    )
+    for bias in args.bias or [1, 10, 100]:
+        simulate(args, albums, bias)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
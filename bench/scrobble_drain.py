@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# Measures how long the scrobbler takes to drain a backlog of pending scrobbles
+# against the fake last.fm server, optionally with injected latency and failures.
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import fake_lastfm
+import lastfm
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="scrobble backlog drain benchmark")
+    parser.add_argument("--backlog", type=int, default=10000)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--rate-limit", type=int, default=0)
+    parser.add_argument("--backoff", type=float, default=lastfm.MIN_BACKOFF)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv[1:])
+
+    server = fake_lastfm.FakeLastFm(
+        latency=args.latency,
+        error_rate=args.error_rate,
+        rate_limit=args.rate_limit,
+        seed=args.seed,
+    ).start()
+    os.environ[lastfm.API_URL_ENV] = server.url
+    lastfm.MIN_BACKOFF = args.backoff
+
+    with tempfile.TemporaryDirectory() as config:
+        os.environ["FOLDERME_CONFIG"] = config
+
+        start = time.perf_counter()
+        cache = lastfm.ScrobbleCache.load()
+        for i in range(args.backlog):
+            s = lastfm.Scrobble()
+            s.artist = f"Artist {i % 100}"
+            s.album = f"Album {i % 1000}"
+            s.title = f"Track {i}"
+            s.is_ended = True
+            s.start_time = 1700000000 + i * 240
+            cache.add(s)
+        print(f"queued {args.backlog} scrobbles in {time.perf_counter() - start:.2f}s")
+
+        start = time.perf_counter()
+        scrobbler = lastfm.Scrobbler("session", True)
+        while not scrobbler.cache.is_empty():
+            time.sleep(0.01)
+        elapsed = time.perf_counter() - start
+        scrobbler.shutdown()
+
+    server.stop()
+    print(
+        f"drained {len(server.scrobbles)} scrobbles in {elapsed:.2f}s "
+        f"({len(server.scrobbles) / elapsed:.0f}/s), {server.requests} requests, "
+        f"{server.errors} injected errors"
+    )
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# Builds a search.SearchIndex over a synthetic collection whose words follow a Zipf
+# distribution, and times queries as they would be typed, one keystroke at a time,
+# for the most common words and a sample of others.
+import argparse
+import os
+import random
+import sys
+import time
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import search
+import util
+
+
+def make_albums(rnd, count, tracks, vocabulary):
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = (
+        "".join(rnd.choices(letters, k=rnd.randint(3, 9))) for _ in range(vocabulary)
+    )
+    words = list(dict.fromkeys(words))
+    weights = [1 / (i + 1) for i in range(len(words))]
+    phrase = lambda n: " ".join(rnd.choices(words, weights, k=rnd.randint(1, n)))
+
+    albums = []
+    for i in range(count):
+        album = types.SimpleNamespace(artist=phrase(3), title=phrase(4))
+        album.tracks = [types.SimpleNamespace(title=phrase(5)) for _ in range(tracks)]
+        albums.append(album)
+    return albums, words
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="search index benchmark")
+    parser.add_argument("--albums", type=int, default=8500)
+    parser.add_argument("--tracks", type=int, default=12, help="tracks per album")
+    parser.add_argument("--vocabulary", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv[1:])
+
+    rnd = random.Random(args.seed)
+    albums, words = make_albums(rnd, args.albums, args.tracks, args.vocabulary)
+    start = time.perf_counter()
+    index = search.SearchIndex(albums)
+    print(
+        f"{len(albums)} albums, {len(albums) * args.tracks} tracks: index built in "
+        f"{(time.perf_counter() - start) * 1000:.0f} ms"
+    )
+
+    queries = {
+        "common words": words[:3],
+        "two common words": [f"{words[0]} {words[1]}", f"{words[2]} {words[0]}"],
+        "other words": rnd.sample(words, args.queries),
+    }
+    for name, texts in queries.items():
+        latency = util.Histogram()
+        for text in texts:
+            for i in range(1, len(text) + 1):
+                t0 = time.perf_counter()
+                index.search(text[:i])
+                latency.add((time.perf_counter() - t0) * 1000)
+        print(f"{name}: {latency}")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
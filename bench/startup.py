@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# Measures the start up cost of loading the UI forms: loading them with loadUiType at
+# runtime, generating the compiled modules on first run, and importing the cached
+# modules. Each run is a fresh interpreter.
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+CHILD = """
+import os, sys, time
+start = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+import util
+from PySide6.QtWidgets import QApplication
+util.UI_PRECOMPILED = sys.argv[2] == "1"
+util.UI_COMPILED_DIR = os.path.join(os.environ["XDG_CACHE_HOME"], "none")
+app = QApplication([])
+for src in sorted(os.listdir(util.UI_DIR)):
+    if src.endswith(".ui"):
+        util.compile_ui(src)
+print(time.perf_counter() - start)
+"""
+
+
+def run(precompiled, cache):
+    env = dict(os.environ, XDG_CACHE_HOME=cache, QT_QPA_PLATFORM="offscreen")
+    start = time.perf_counter()
+    out = subprocess.run(
+        [sys.executable, "-c", CHILD, SRC, "1" if precompiled else "0"],
+        env=env,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return float(out.split()[-1]) * 1000, (time.perf_counter() - start) * 1000
+
+
+def report(name, samples):
+    forms = statistics.median(s[0] for s in samples)
+    total = statistics.median(s[1] for s in samples)
+    print(f"{name:>12}: forms {forms:7.1f}ms, process {total:7.1f}ms (median)")
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="UI form loading benchmark")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args(argv[1:])
+
+    report("loadUiType", [run(False, tempfile.mkdtemp()) for _ in range(args.runs)])
+    report("first run", [run(True, tempfile.mkdtemp()) for _ in range(args.runs)])
+
+    cache = tempfile.mkdtemp()
+    run(True, cache)
+    report("cached", [run(True, cache) for _ in range(args.runs)])
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -1,10 +1,14 @@
 # SPDX-License-Identifier: BSD-2-Clause
+import os
+import signal
 import sys
 
 import app
 import browser
 import collection
 import config
+import control
+import history
 import ipc
 import lastfm
 import osd
@@ -21,6 +25,7 @@ from PySide6.QtWidgets import QSystemTrayIcon
 _INSTANCE = None
 BaseMainWindow = util.compile_ui("main.ui")
 BIAS_CFG_KEY = "playlist/bias"
+WEIGHTED_CFG_KEY = "playlist/weighted"
 
 
 class TrayIcon(QSystemTrayIcon, util.Listener):
@@ -95,6 +100,7 @@ class MainWindow(BaseMainWindow, util.Listener):
         self.config.clicked.connect(lambda x: self.show_config())
         self.quit.clicked.connect(lambda x: self.handleQuit())
 
+        self._browser = None
         self.playlistUI.setFocus()
         util.restore_ui(self, "main")
 
@@ -123,7 +129,10 @@ class MainWindow(BaseMainWindow, util.Listener):
         super().closeEvent(e)
 
     def show_browser(self):
-        browser.BrowseDialog(self).show()
+        if not self._browser:
+            self._browser = browser.BrowseDialog(self)
+        self._browser.show()
+        self._browser.raise_()
 
     def show_config(self):
         cfg = config.ConfigDialog()
@@ -145,6 +154,8 @@ class FolderME(QApplication):
         self._pixmaps = util.PixmapCache()
         self._collection = collection.Collection.load()
         self._playlist = playlist.Playlist.load()
+        self._history = history.History()
+        util.EventBus.add(self._history)
         self._scrobbler = lastfm.get_scrobbler(not args.no_lastfm)
         if self._scrobbler:
             util.EventBus.add(self._scrobbler)
@@ -155,6 +166,8 @@ class FolderME(QApplication):
         if bias:
             self._bias = int(bias)
 
+        self._weighted = util.SETTINGS.value(WEIGHTED_CFG_KEY) == "true"
+
     @property
     def pixmaps(self):
         return self._pixmaps
@@ -167,6 +180,10 @@ class FolderME(QApplication):
     def playlist(self):
         return self._playlist
 
+    @property
+    def history(self):
+        return self._history
+
     @property
     def bias(self):
         return self._bias
@@ -175,11 +192,24 @@ class FolderME(QApplication):
         self._bias = bias
         util.SETTINGS.setValue(BIAS_CFG_KEY, str(bias))
 
+    @property
+    def weighted(self):
+        return self._weighted
+
+    def set_weighted(self, weighted):
+        self._weighted = weighted
+        util.SETTINGS.setValue(WEIGHTED_CFG_KEY, str(weighted).lower())
+
     def save(self):
         self.playlist.save()
 
     def exit(self):
         self.save()
+        self.playlist.shutdown()
+        self.playlist.player().report()
+        util.EventBus.shutdown()
+        if util.EventBus.STATS:
+            util.EventBus.STATS.dump()
         if self._scrobbler:
             self._scrobbler.shutdown()
         self.quit()
@@ -191,6 +221,14 @@ def init(args):
     if args.no_save:
         util.ConfigObj.SAVE_ENABLED = False
 
+    if args.event_stats:
+        util.EventBus.STATS = util.EventStats(args.event_budget)
+
+    if not args.no_dbus:
+        # D-Bus is served from its own GLib main loop thread (see ipc.Server), so Qt
+        # must not dispatch the default GLib context on the GUI thread too.
+        os.environ["QT_NO_GLIB"] = "1"
+
     _INSTANCE = FolderME()
     _INSTANCE.init(args)
 
@@ -211,9 +249,27 @@ def start(args):
     if not args.no_dbus:
         server = ipc.Server(mainUI)
 
+    if not args.no_control:
+        try:
+            control_server = control.ControlServer(mainUI)
+            get().aboutToQuit.connect(control_server.close)
+        except Exception as e:
+            print(f"control: not listening: {e}")
+
     tray = TrayIcon(mainUI)
     tray.show()
 
+    if util.EventBus.STATS:
+        signal.signal(
+            signal.SIGUSR1,
+            lambda *_: QTimer.singleShot(0, util.EventBus.STATS.dump),
+        )
+        # Python signal handlers only run when the interpreter gets control, so
+        # wake it up periodically while the Qt event loop runs.
+        signal_timer = QTimer()
+        signal_timer.timeout.connect(lambda: None)
+        signal_timer.start(500)
+
     if args.show:
         mainUI.show()
 
@@ -1,115 +1,320 @@
 # SPDX-License-Identifier: BSD-2-Clause
+import bisect
 import collections
 
 import app
+import search
 import util
+from PySide6.QtCore import QAbstractListModel
+from PySide6.QtCore import QModelIndex
+from PySide6.QtCore import QSize
 from PySide6.QtCore import Qt
-from PySide6.QtGui import QPixmap
-from PySide6.QtWidgets import QListWidgetItem
+from PySide6.QtWidgets import QListView
 
+COVER_SIZE = 128
+FETCH_SIZE = 200
 
-class AlbumEntry(util.compile_ui("browser_album.ui")):
-    def __init__(self, parent, album):
-        super().__init__(parent)
-        self.album = album
+_ARTISTS = None
+
+
+def artist_model():
+    """
+    Returns the artist model, which lives for as long as the application so that it
+    does not have to be rebuilt every time the browser is opened.
+    """
+    global _ARTISTS
+    if not _ARTISTS:
+        _ARTISTS = ArtistModel()
+    return _ARTISTS
+
+
+def _group(name):
+    first = name[0].upper() if name else "#"
+    return first if first.isalpha() else "#"
+
+
+def _sort_key(name):
+    if name == "Various":
+        return (1, "", name.lower())
+    return (0, _group(name), name.lower())
+
+
+class LazyListModel(QAbstractListModel):
+    """
+    A list model that only exposes its rows to views in chunks of `FETCH_SIZE`, as
+    they are scrolled into view.
+    """
+
+    def __init__(self):
+        QAbstractListModel.__init__(self)
+        self._rows = []
+        self._loaded = 0
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self._loaded
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and self._loaded < len(self._rows)
+
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid():
+            return
+        count = min(FETCH_SIZE, len(self._rows) - self._loaded)
+        if count > 0:
+            self.beginInsertRows(QModelIndex(), self._loaded, self._loaded + count - 1)
+            self._loaded += count
+            self.endInsertRows()
+
+    def _reset(self, rows):
+        self.beginResetModel()
+        self._rows = rows
+        self._loaded = 0
+        self.endResetModel()
+
+    def _insert_row(self, pos, row):
+        if pos <= self._loaded:
+            self.beginInsertRows(QModelIndex(), pos, pos)
+            self._rows.insert(pos, row)
+            self._loaded += 1
+            self.endInsertRows()
+        else:
+            self._rows.insert(pos, row)
 
-        cover = album.tracks[0].cover_art()
-        pixmap = QPixmap()
-        if cover:
-            pixmap.loadFromData(cover)
+    def _remove_row(self, pos):
+        if pos < self._loaded:
+            self.beginRemoveRows(QModelIndex(), pos, pos)
+            del self._rows[pos]
+            self._loaded -= 1
+            self.endRemoveRows()
         else:
-            pixmap.load(util.icon("blank.jpg"))
+            del self._rows[pos]
+
+
+class ArtistModel(LazyListModel, util.Listener):
+    """
+    Sorted list of artists as `(key, name)` rows, with a separator row (`name` None)
+    at the start of each letter group.
+    """
+
+    def __init__(self):
+        LazyListModel.__init__(self)
+        self._keys = []
+        self._albums = collections.defaultdict(list)
+        for a in app.get().collection.albums:
+            self._albums[a.artist].append(a)
+
+        for lst in self._albums.values():
+            lst.sort(key=lambda a: (a.year, a.title))
+
+        rows = []
+        for name in sorted(self._albums.keys(), key=_sort_key):
+            key = _sort_key(name)
+            if key[0] == 0 and (not rows or rows[-1][0][1] != key[1]):
+                rows.append(((0, key[1], ""), None))
+            rows.append((key, name))
+
+        self._keys = [r[0] for r in rows]
+        self._reset(rows)
+        util.EventBus.add(self)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or role != Qt.DisplayRole:
+            return None
+        key, name = self._rows[index.row()]
+        return name if name is not None else key[1]
+
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.NoItemFlags
+        if self._rows[index.row()][1] is None:
+            return Qt.NoItemFlags
+        return Qt.ItemIsEnabled
+
+    def artist(self, index):
+        return self._rows[index.row()][1]
+
+    def albums(self, artist):
+        return self._albums.get(artist, [])
+
+    def collection_updated(self, added, removed):
+        for a in removed:
+            albums = self._albums.get(a.artist)
+            if albums is None or a not in albums:
+                continue
+            albums.remove(a)
+            if not albums:
+                del self._albums[a.artist]
+                self._remove_artist(a.artist)
+
+        for a in added:
+            albums = self._albums[a.artist]
+            if not albums:
+                self._add_artist(a.artist)
+            albums.append(a)
+            albums.sort(key=lambda a: (a.year, a.title))
 
-        util.set_pixmap(self.cover, pixmap)
-        self._title_helper = util.ElisionHelper(self, self.lAlbum, album.title, 128)
-        self.lYear.setText(str(album.year))
+    def _add_artist(self, name):
+        key = _sort_key(name)
+        if key[0] == 0:
+            sep = (0, key[1], "")
+            pos = bisect.bisect_left(self._keys, sep)
+            if pos == len(self._keys) or self._keys[pos] != sep:
+                self._insert(pos, (sep, None))
 
+        self._insert(bisect.bisect_left(self._keys, key), (key, name))
 
-class BrowseDialog(util.compile_ui("browser.ui")):
+    def _remove_artist(self, name):
+        key = _sort_key(name)
+        pos = bisect.bisect_left(self._keys, key)
+        if pos == len(self._keys) or self._keys[pos] != key:
+            return
+        self._remove(pos)
+
+        # Drop the letter separator if this was the last artist in the group.
+        if key[0] == 0 and pos > 0 and self._keys[pos - 1] == (0, key[1], ""):
+            if pos == len(self._keys) or self._keys[pos][:2] != key[:2]:
+                self._remove(pos - 1)
+
+    def _insert(self, pos, row):
+        self._keys.insert(pos, row[0])
+        self._insert_row(pos, row)
+
+    def _remove(self, pos):
+        del self._keys[pos]
+        self._remove_row(pos)
+
+
+class AlbumModel(LazyListModel):
+    """
+    The albums of a single artist, shown as a cover grid. Covers are only loaded
+    when a view asks for them, i.e., when the album is scrolled into view.
+    """
+
+    def set_albums(self, albums):
+        self._reset(list(albums))
+        self.fetchMore()
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+
+        album = self._rows[index.row()]
+        if role == Qt.DisplayRole:
+            return f"{album.title}\n{album.year}"
+        elif role == Qt.ToolTipRole:
+            return album.title
+        elif role == Qt.DecorationRole:
+            return app.get().pixmaps.get_track_cover(album.tracks[0], COVER_SIZE)
+        return None
+
+    def flags(self, index):
+        return Qt.ItemIsEnabled if index.isValid() else Qt.NoItemFlags
+
+    def album(self, index):
+        return self._rows[index.row()]
+
+
+class SearchModel(QAbstractListModel):
+    def __init__(self):
+        QAbstractListModel.__init__(self)
+        self._results = []
+
+    def set_results(self, results):
+        self.beginResetModel()
+        self._results = results
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._results)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if index.isValid() and role == Qt.DisplayRole:
+            return str(self._results[index.row()])
+        return None
+
+    def result(self, row):
+        return self._results[row] if row < len(self._results) else None
+
+
+class BrowseDialog(util.compile_ui("browser.ui"), util.Listener):
     def __init__(self, parent):
         super().__init__(parent)
         self.bRescan.clicked.connect(self._rescan)
         self.bClose.clicked.connect(self.close)
-        self.albums.itemActivated.connect(self._add_album)
-        self.artists.itemActivated.connect(self._populate_albums)
+
+        self.artists.setModel(artist_model())
+        self.artists.setUniformItemSizes(True)
+        self.artists.activated.connect(self._populate_albums)
+
+        self._albums = AlbumModel()
+        self.albums.setModel(self._albums)
+        self.albums.setViewMode(QListView.IconMode)
+        self.albums.setIconSize(QSize(COVER_SIZE, COVER_SIZE))
+        self.albums.setGridSize(QSize(COVER_SIZE + 32, COVER_SIZE + 48))
+        self.albums.setResizeMode(QListView.Adjust)
+        self.albums.setMovement(QListView.Static)
+        self.albums.setUniformItemSizes(True)
+        self.albums.setWordWrap(True)
+        self.albums.activated.connect(self._add_album)
+
+        self._results = SearchModel()
+        self.results.setModel(self._results)
+        self.results.hide()
+        self.results.activated.connect(self._add_result)
+        self.search.textChanged.connect(self._search)
+        self.search.returnPressed.connect(lambda: self._add_result(None))
+
+        self._placeholder = self.search.placeholderText()
+        if not search.index():
+            self.search.setPlaceholderText("Indexing collection...")
+            search.build(self._index_ready)
+
+        self._artist = None
         self._scanning = False
-        self._populate_artists()
+        util.EventBus.add(self)
         util.restore_ui(self, "browser")
 
     def closeEvent(self, e):
         util.save_ui(self, "browser")
         super().closeEvent(e)
 
-    def _add_album(self, item):
-        e = self.albums.itemWidget(item)
-        app.get().playlist.add_album(e.album)
+    def collection_changed(self):
+        if self._artist:
+            self._albums.set_albums(artist_model().albums(self._artist))
 
-    def _populate_artists(self):
-        self.artists_map = collections.defaultdict(list)
-        for a in app.get().collection.albums:
-            self.artists_map[a.artist].append(a)
+    def _add_album(self, index):
+        app.get().playlist.add_album(self._albums.album(index))
 
-        for _, lst in self.artists_map.items():
-            lst.sort(key=lambda a: (a.year, a.title))
+    def _add_result(self, index):
+        result = self._results.result(index.row() if index else 0)
+        if result:
+            app.get().playlist.add_album(result.album)
+
+    def _search(self, text):
+        if not text.strip():
+            self.results.hide()
+            self._results.set_results([])
+            return
+
+        idx = search.index()
+        if not idx:
+            # Searched again once the index is ready.
+            search.build(self._index_ready)
+            return
+
+        self._results.set_results(idx.search(text))
+        self.results.show()
+
+    def _index_ready(self):
+        self.search.setPlaceholderText(self._placeholder)
+        self._search(self.search.text())
 
-        names = list(self.artists_map.keys())
-
-        def sort_key(name):
-            if name == "Various":
-                return (1, name.lower())
-            return (0, name)
-
-        names = sorted(names, key=sort_key)
-        prev = None
-        for n in names:
-            first = n[0].lower()
-
-            add_separator = False
-            if prev == "#":
-                try:
-                    int(first)
-                except:
-                    add_separator = True
-                    prev = first
-            elif prev:
-                add_separator = first != prev
-                prev = first
-            else:
-                add_separator = True
-                try:
-                    int(first)
-                    first = "#"
-                    prev = first
-                except:
-                    prev = first
-
-            if add_separator:
-                i = QListWidgetItem(first.upper())
-                i.setFlags(i.flags() & ~Qt.ItemIsSelectable & ~Qt.ItemIsEnabled)
-                self.artists.addItem(i)
-
-            i = QListWidgetItem(n)
-            i.setFlags(i.flags() & ~Qt.ItemIsSelectable)
-            self.artists.addItem(i)
-
-        self.repaint()
-
-    def _populate_albums(self, item):
-        self.albums.clear()
-        albums = self.artists_map.get(item.text())
-
-        for a in albums:
-            ui = AlbumEntry(self.albums, a)
-            i = QListWidgetItem(self.albums)
-            i.setFlags(i.flags() & ~Qt.ItemIsSelectable)
-            i.setSizeHint(ui.sizeHint())
-            self.albums.addItem(i)
-            self.albums.setItemWidget(i, ui)
+    def _populate_albums(self, index):
+        self._artist = artist_model().artist(index)
+        if self._artist:
+            self._albums.set_albums(artist_model().albums(self._artist))
 
     def _rescan(self):
         app.get().collection.scan(self)
-        self.artists.clear()
-        self.albums.clear()
-        self._populate_artists()
         self.bRescan.setEnabled(True)
         self.bClose.setEnabled(True)
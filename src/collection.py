@@ -1,5 +1,6 @@
 # SPDX-License-Identifier: BSD-2-Clause
 import os
+import threading
 
 import mutagen
 import util
@@ -172,6 +173,8 @@ class Scanner(QThread):
     def __init__(self, collection):
         QThread.__init__(self)
         self.collection = collection
+        self.added = []
+        self.removed = []
 
     def run(self):
         albums = []
@@ -190,9 +193,12 @@ class Scanner(QThread):
                         a = Album()
                         a.init(root, files=files)
                         albums.append(a)
+                        self.added.append(a)
                     except:
                         pass
 
+        kept = {id(a) for a in albums}
+        self.removed = [a for a in self.collection.albums if id(a) not in kept]
         self.collection.albums = albums
         self.done.emit()
 
@@ -213,6 +219,8 @@ class Collection(util.ConfigObj):
         self.version = -1
         self._scanner = None
         self._by_path = None
+        # get_album() is also called from listener worker threads.
+        self._by_path_lock = threading.Lock()
 
     def needs_rescan(self):
         return self.version != METADATA_VERSION
@@ -232,10 +240,16 @@ class Collection(util.ConfigObj):
     def scan_done(self):
         self.version = METADATA_VERSION
         self.save()
+        added = self._scanner.added
+        removed = self._scanner.removed
         self._scanner = None
+        with self._by_path_lock:
+            self._by_path = None
+        util.EventBus.send(util.Listener.collection_updated, added, removed)
         util.EventBus.send(util.Listener.collection_changed)
 
     def get_album(self, path):
-        if not self._by_path:
-            self._by_path = {x.path: x for x in self.albums}
-        return self._by_path.get(path)
+        with self._by_path_lock:
+            if not self._by_path:
+                self._by_path = {x.path: x for x in self.albums}
+            return self._by_path.get(path)
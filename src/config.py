@@ -12,6 +12,7 @@ class ConfigDialog(util.compile_ui("config.ui")):
             self.lSources.addItem(path)
 
         self.sbBias.setValue(app.get().bias)
+        self.cbWeighted.setChecked(app.get().weighted)
         self.accepted.connect(self._ok)
         self.rejected.connect(self._cancel)
 
@@ -34,6 +35,7 @@ class ConfigDialog(util.compile_ui("config.ui")):
 
         app.get().collection.save()
         app.get().set_bias(self.sbBias.value())
+        app.get().set_weighted(self.cbWeighted.isChecked())
         app.get().save()
 
     def _cancel(self):
@@ -0,0 +1,209 @@
+# SPDX-License-Identifier: BSD-2-Clause
+import contextlib
+import io
+import json
+import os
+import socket
+import socketserver
+import threading
+
+import app
+import osd
+import remote
+import util
+
+# Commands accepted over the control socket; see `Remote`.
+COMMANDS = {
+    "enqueue",
+    "next",
+    "osd",
+    "pause",
+    "play",
+    "playpause",
+    "prev",
+    "quit",
+    "stats",
+    "status",
+    "stop",
+    "stop_after_track",
+}
+
+# How long to wait for the GUI thread to run a batch of commands, in seconds.
+TIMEOUT = 5
+
+# Reports printed by the "stats" command after the player's own, e.g. MPRIS signal
+# counts when D-Bus is enabled.
+REPORTS = []
+
+
+class Remote:
+    """
+    Commands received from other processes, over D-Bus or the control socket. These
+    run on the GUI thread.
+    """
+
+    def __init__(self, ui):
+        self.ui = ui
+
+    def playpause(self):
+        plist = app.get().playlist
+        if not plist.albums and not plist.is_playing():
+            self.ui.driver.pick_next(play=True)
+        else:
+            plist.playpause()
+
+    def stop(self):
+        app.get().playlist.stop()
+
+    def quit(self):
+        self.ui.handleQuit()
+
+    def next(self):
+        app.get().playlist.next()
+
+    def prev(self):
+        app.get().playlist.prev()
+
+    def pause(self):
+        app.get().playlist.pause()
+
+    def play(self):
+        pl = app.get().playlist
+        if pl.is_paused():
+            pl.playpause()
+        else:
+            pl.play(pl.current_track())
+
+    def go_to(self, track):
+        app.get().playlist.go_to(track)
+
+    def stop_after_track(self):
+        value = app.get().playlist.stop_after(app.get().playlist.current_track())
+        text = "On" if value else "Off"
+        osd.show_msg(f"Stop After Track: {text}")
+
+    def osd(self):
+        osd.show_track(None)
+
+    def stats(self):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            app.get().playlist.player().report()
+            for report in REPORTS:
+                report()
+            if util.EventBus.STATS:
+                util.EventBus.STATS.dump()
+        # Also printed on the player's output, as before.
+        print(out.getvalue(), end="")
+        return out.getvalue()
+
+    def enqueue(self, path, play=False):
+        album = app.get().collection.get_album(os.path.normpath(path))
+        if not album:
+            raise ValueError(f"Album {path} not found in collection.")
+        app.get().playlist.add_album(album)
+        if play and not app.get().playlist.is_playing():
+            app.get().playlist.playpause()
+
+    def status(self):
+        pl = app.get().playlist
+        state = "stopped"
+        if pl.is_playing():
+            state = "playing"
+        elif pl.is_paused():
+            state = "paused"
+
+        track = pl.player().track()
+        info = None
+        if track:
+            info = {
+                "artist": track.artist,
+                "album": track.album,
+                "title": track.title,
+                "path": track.path,
+                "duration_ms": track.duration_ms,
+            }
+        return {
+            "state": state,
+            "track": info,
+            "position_ms": pl.player().position(),
+            "albums": len(pl.albums),
+        }
+
+
+class ControlServer(socketserver.ThreadingUnixStreamServer):
+    """
+    Control endpoint on a Unix socket, taking one JSON command or list of commands per
+    line and answering each line with the results; see `remote.request()`.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, ui):
+        self.path = remote.control_socket()
+        if os.path.exists(self.path):
+            if _is_listening(self.path):
+                raise Exception("Control socket already in use.")
+            os.unlink(self.path)
+
+        super().__init__(self.path, ControlHandler)
+        os.chmod(self.path, 0o600)
+
+        self.remote = Remote(ui)
+        self._queue = util.GuiQueue()
+        self._thread = threading.Thread(
+            target=self.serve_forever, name="control", daemon=True
+        )
+        self._thread.start()
+
+    def execute(self, request):
+        batch = isinstance(request, list)
+        commands = request if batch else [request]
+        try:
+            results = self._queue.run(self._run_batch, commands, timeout=TIMEOUT)
+        except TimeoutError:
+            raise Exception(
+                f"player did not run the commands within {TIMEOUT}s; they may still run"
+            )
+        return results if batch else results[0]
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def _run_batch(self, commands):
+        results = []
+        for command in commands:
+            try:
+                args = dict(command)
+                name = args.pop("cmd", None)
+                if name not in COMMANDS:
+                    raise ValueError(f"Unknown command: {name}")
+                result = getattr(self.remote, name)(**args)
+                results.append({"ok": True, "result": result})
+            except Exception as e:
+                results.append({"ok": False, "error": str(e)})
+        return results
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = self.server.execute(json.loads(line))
+            except Exception as e:
+                response = {"ok": False, "error": str(e)}
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+
+def _is_listening(path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        try:
+            s.connect(path)
+            return True
+        except OSError:
+            return False
@@ -0,0 +1,270 @@
+# SPDX-License-Identifier: BSD-2-Clause
+import collections
+import heapq
+import json
+import os
+import struct
+import threading
+import time
+
+import app
+import util
+
+# Log records. Album paths are written once, and referred to by id afterwards.
+PATH_RECORD = struct.Struct("<cIH")
+PLAY_RECORD = struct.Struct("<cIIHIB")
+PATH = b"P"
+PLAY = b"E"
+
+COMPLETED = 1
+
+
+class Play:
+    def __init__(self, timestamp, path, track, played_ms, completed):
+        self.timestamp = timestamp
+        self.path = path
+        self.track = track
+        self.played_ms = played_ms
+        self.completed = completed
+
+
+class History(util.Listener):
+    """
+    Local record of played tracks: an append-only binary log, plus daily per-album
+    aggregates checkpointed to an index so that startup only reads the newer log.
+    """
+
+    # History writes go to disk, so keep them off the GUI thread.
+    ASYNC = True
+    ASYNC_QUEUE_DEPTH = 1024
+
+    CHECKPOINT_RECORDS = 1000
+
+    def __init__(self, path=None):
+        path = path or util.config_dir()
+        self._log_path = os.path.join(path, "history.log")
+        self._index_path = os.path.join(path, "history.index")
+        self._log = None
+        self._pending = 0
+        self._lock = threading.Lock()
+
+        self._paths = []
+        self._path_ids = {}
+        self._days = collections.defaultdict(dict)
+        self._last = {}
+        self._plays = collections.Counter()
+        self._offset = 0
+
+        self._track = None
+        self._played = util.PlayedTime()
+
+        self._load()
+
+    def track_playing(self, track):
+        if track is not self._track:
+            self._finish(False)
+            self._track = track
+            self._played.reset()
+
+    def track_position_changed(self, track, position):
+        if track is not self._track:
+            return
+        self._played.update(position)
+
+    def track_ended(self, track):
+        if track is self._track:
+            # Account for the part played since the last position update.
+            self._played.update(track.duration_ms)
+            self._finish(True)
+
+    def track_changed(self, track):
+        if track is not self._track:
+            self._finish(False)
+
+    def ui_exit(self):
+        self._finish(False)
+        self.checkpoint()
+
+    def add(self, play):
+        """
+        Records a play, both in the log and in the aggregates.
+        """
+        if not util.ConfigObj.SAVE_ENABLED:
+            return
+
+        path_id = self._path_ids.get(play.path)
+        data = b""
+        if path_id is None:
+            path_id = self._add_path(play.path)
+            encoded = play.path.encode("utf-8")
+            data += PATH_RECORD.pack(PATH, path_id, len(encoded)) + encoded
+
+        flags = COMPLETED if play.completed else 0
+        data += PLAY_RECORD.pack(
+            PLAY, int(play.timestamp), path_id, play.track, play.played_ms, flags
+        )
+        self._append(data)
+        self._aggregate(int(play.timestamp), path_id, play.played_ms, play.completed)
+
+        self._pending += 1
+        if self._pending >= self.CHECKPOINT_RECORDS:
+            self.checkpoint()
+
+    def last_played(self, path):
+        """
+        Returns the timestamp of the last play of the album at `path`, or None.
+        """
+        with self._lock:
+            path_id = self._path_ids.get(path)
+            return self._last.get(path_id) if path_id is not None else None
+
+    def plays(self, path):
+        """
+        Returns the number of completed track plays of the album at `path`.
+        """
+        with self._lock:
+            path_id = self._path_ids.get(path)
+            return self._plays[path_id] if path_id is not None else 0
+
+    def top_albums(self, start, end, limit=10):
+        """
+        Returns (path, plays, played ms) for the albums with most completed track
+        plays between the `start` and `end` timestamps, at day granularity.
+        """
+        totals = collections.defaultdict(lambda: [0, 0])
+        with self._lock:
+            for day in range(int(start) // 86400, int(end) // 86400 + 1):
+                for path_id, (plays, ms) in self._days.get(day, {}).items():
+                    totals[path_id][0] += plays
+                    totals[path_id][1] += ms
+
+            top = heapq.nlargest(limit, totals.items(), key=lambda x: tuple(x[1]))
+            return [(self._paths[path_id], plays, ms) for path_id, (plays, ms) in top]
+
+    def top_artists(self, start, end, limit=10):
+        """
+        Returns (artist, plays, played ms) for the artists with most completed track
+        plays between the `start` and `end` timestamps.
+        """
+        totals = collections.defaultdict(lambda: [0, 0])
+        for path, plays, ms in self.top_albums(start, end, limit=len(self._paths)):
+            album = app.get().collection.get_album(path)
+            artist = album.artist if album else os.path.basename(path)
+            totals[artist][0] += plays
+            totals[artist][1] += ms
+
+        top = heapq.nlargest(limit, totals.items(), key=lambda x: tuple(x[1]))
+        return [(artist, plays, ms) for artist, (plays, ms) in top]
+
+    def checkpoint(self):
+        """
+        Writes the aggregates to the index, so that the log up to the current offset
+        does not need to be read again.
+        """
+        if not util.ConfigObj.SAVE_ENABLED or not self._pending:
+            return
+
+        with self._lock:
+            data = json.dumps(
+                {
+                    "offset": self._offset,
+                    "paths": self._paths,
+                    "last": self._last,
+                    "days": self._days,
+                }
+            )
+        util.atomic_write(self._index_path, data)
+        self._pending = 0
+
+    def _finish(self, completed):
+        track = self._track
+        self._track = None
+        if not track:
+            return
+
+        path = os.path.dirname(track.path)
+        album = app.get().collection.get_album(path)
+        index = album.tracks.index(track) if album and track in album.tracks else 0
+        self.add(Play(time.time(), path, index, int(self._played.ms), completed))
+
+    def _add_path(self, path):
+        with self._lock:
+            path_id = len(self._paths)
+            self._paths.append(path)
+            self._path_ids[path] = path_id
+            return path_id
+
+    def _aggregate(self, timestamp, path_id, played_ms, completed):
+        with self._lock:
+            day = self._days[timestamp // 86400]
+            plays, ms = day.get(path_id, (0, 0))
+            day[path_id] = (plays + (1 if completed else 0), ms + played_ms)
+            self._last[path_id] = max(self._last.get(path_id, 0), timestamp)
+            if completed:
+                self._plays[path_id] += 1
+
+    def _append(self, data):
+        if not self._log:
+            os.makedirs(os.path.dirname(self._log_path), exist_ok=True)
+            self._log = open(self._log_path, "ab")
+        self._log.write(data)
+        self._log.flush()
+        if hasattr(os, "fdatasync"):
+            os.fdatasync(self._log.fileno())
+        self._offset += len(data)
+
+    def _load(self):
+        if os.path.isfile(self._index_path):
+            try:
+                with open(self._index_path, encoding="utf-8") as f:
+                    data = json.load(f)
+                for path in data["paths"]:
+                    self._add_path(path)
+                self._last = {int(k): v for k, v in data["last"].items()}
+                for day, albums in data["days"].items():
+                    self._days[int(day)] = {int(k): tuple(v) for k, v in albums.items()}
+                for albums in self._days.values():
+                    for path_id, (plays, _) in albums.items():
+                        self._plays[path_id] += plays
+                self._offset = data["offset"]
+            except Exception:
+                print("Error reading history index, rebuilding from log.")
+                util.print_error()
+                self._paths = []
+                self._path_ids = {}
+                self._days = collections.defaultdict(dict)
+                self._last = {}
+                self._plays = collections.Counter()
+                self._offset = 0
+
+        if os.path.isfile(self._log_path):
+            self._replay()
+
+    def _replay(self):
+        with open(self._log_path, "r+b") as f:
+            f.seek(self._offset)
+            data = f.read()
+            pos = 0
+            while pos < len(data):
+                kind = data[pos : pos + 1]
+                if kind == PATH and pos + PATH_RECORD.size <= len(data):
+                    _, path_id, size = PATH_RECORD.unpack_from(data, pos)
+                    end = pos + PATH_RECORD.size + size
+                    if end > len(data):
+                        break
+                    path = data[pos + PATH_RECORD.size : end].decode("utf-8")
+                    self._add_path(path)
+                    pos = end
+                elif kind == PLAY and pos + PLAY_RECORD.size <= len(data):
+                    _, ts, path_id, _, ms, flags = PLAY_RECORD.unpack_from(data, pos)
+                    self._aggregate(ts, path_id, ms, flags & COMPLETED)
+                    pos += PLAY_RECORD.size
+                else:
+                    break
+
+            if pos:
+                self._pending += 1
+            self._offset += pos
+            if self._offset < os.fstat(f.fileno()).st_size:
+                # Drop a partially written record at the end of the log.
+                f.truncate(self._offset)
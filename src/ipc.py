@@ -1,56 +1,42 @@
 # SPDX-License-Identifier: BSD-2-Clause
+import collections
 import os
 import pathlib
+import threading
+import time
 import uuid
+import weakref
 
 import app
+import control
 import dbus
 import dbus.service
-import osd
 import remote
 import util
+from PySide6.QtCore import QTimer
 from dbus.mainloop.glib import DBusGMainLoop
+from dbus.mainloop.glib import threads_init
+from gi.repository import GLib
 
 MP_IFACE = "org.mpris.MediaPlayer2"
 PLAYER_IFACE = "org.mpris.MediaPlayer2.Player"
+TRACKLIST_IFACE = "org.mpris.MediaPlayer2.TrackList"
 PROPS_IFACE = "org.freedesktop.DBus.Properties"
 
+TRACK_PATH = f"{remote.DBUS_OBJECT}/track"
+NO_TRACK = "/org/mpris/MediaPlayer2/TrackList/NoTrack"
 
-class Remote:
-    def __init__(self, ui):
-        self.ui = ui
-
-    def playpause(self):
-        plist = app.get().playlist
-        if not plist.albums and not plist.is_playing():
-            self.ui.driver.pick_next(play=True)
-        else:
-            plist.playpause()
-
-    def stop(self):
-        app.get().playlist.stop()
-
-    def quit(self):
-        self.ui.handleQuit()
-
-    def next(self):
-        app.get().playlist.next()
-
-    def prev(self):
-        app.get().playlist.prev()
-
-    def pause(self):
-        app.get().playlist.pause()
-
-    def play(self):
-        pl = app.get().playlist
-        if pl.is_paused():
-            pl.playpause()
-        else:
-            pl.play(pl.current_track())
+# Track list changes larger than this are sent as a TrackListReplaced signal
+# instead of individual TrackAdded / TrackRemoved ones.
+MAX_TRACK_SIGNALS = 50
 
 
 class MPRIS(dbus.service.Object, util.Listener):
+    """
+    MPRIS interface for the player, served from a snapshot of the player state so
+    that D-Bus calls never wait for the GUI thread.
+    """
+
     OBJECT = "/org/mpris/MediaPlayer2"
     SERVICE = "org.mpris.MediaPlayer2.folderme"
 
@@ -58,6 +44,9 @@ class MPRIS(dbus.service.Object, util.Listener):
         bus_name = dbus.service.BusName(self.SERVICE, bus=bus)
         util.EventBus.add(self)
 
+        self._lock = threading.Lock()
+        self._clock = (0, time.monotonic(), False)
+
         self._covers_dir = os.path.join(util.config_dir(), "covers")
         if not os.path.isdir(self._covers_dir):
             os.mkdir(self._covers_dir)
@@ -67,16 +56,24 @@ class MPRIS(dbus.service.Object, util.Listener):
         self._cover_path = None
         self._cover_uri = None
         self._cover_album = None
+        self._meta_track = None
+        self._metadata = None
 
-        track = app.get().playlist.current_track()
-        if track:
-            self._set_cover(track.info)
+        self._ids = weakref.WeakKeyDictionary()
+        self._tracks = weakref.WeakValueDictionary()
+        self._next_id = 0
+        self._track_list = []
+
+        self._emitted = {}
+        self._pending = {}
+        self._flush_scheduled = False
+        self.counts = collections.Counter()
 
         self.props = {
             MP_IFACE: {
                 "CanQuit": True,
                 "CanRaise": False,
-                "HasTrackList": False,
+                "HasTrackList": True,
                 "Identity": "FolderME",
                 "DesktopEntry": "org.vanzin.FolderME",
             },
@@ -88,7 +85,6 @@ class MPRIS(dbus.service.Object, util.Listener):
                 "CanSeek": False,
                 "CanControl": True,
                 "Volume": 1.0,
-                "Position": dbus.Int64(0),
                 "Shuffle": False,
                 "Rate": 1.0,
                 "MinimumRate": 1.0,
@@ -96,8 +92,16 @@ class MPRIS(dbus.service.Object, util.Listener):
                 "LoopStatus": "None",
                 "PlaybackStatus": "Stopped",
             },
+            TRACKLIST_IFACE: {
+                "Tracks": dbus.Array([], signature="o"),
+                "CanEditTracks": False,
+            },
         }
-        self._update_player_props(emit=False)
+        self._track_list = self._queued_ids()
+        self._set_tracks_prop()
+        self._update_player_props()
+        self._emitted = {PLAYER_IFACE: dict(self.props[PLAYER_IFACE])}
+        self._pending = {}
 
         dbus.service.Object.__init__(self, bus, self.OBJECT, bus_name=bus_name)
         self.remote = remote
@@ -146,7 +150,10 @@ class MPRIS(dbus.service.Object, util.Listener):
         dbus_interface=PROPS_IFACE, in_signature="ss", out_signature="v"
     )
     def Get(self, iface, prop):
-        return self.props.get(iface, {}).get(prop)
+        if iface == PLAYER_IFACE and prop == "Position":
+            return self._position()
+        with self._lock:
+            return self.props.get(iface, {}).get(prop)
 
     @dbus.service.method(
         dbus_interface=PROPS_IFACE, in_signature="ssv", out_signature=""
@@ -158,34 +165,112 @@ class MPRIS(dbus.service.Object, util.Listener):
         dbus_interface=PROPS_IFACE, in_signature="s", out_signature="a{sv}"
     )
     def GetAll(self, iface):
-        return self.props.get(iface, {})
+        with self._lock:
+            props = self.props.get(iface, {})
+        if iface == PLAYER_IFACE:
+            props = dict(props, Position=self._position())
+        return props
 
     @dbus.service.signal(dbus_interface=PROPS_IFACE, signature="sa{sv}as")
     def PropertiesChanged(self, iface, props, invalid):
         pass
 
+    @dbus.service.signal(dbus_interface=PLAYER_IFACE, signature="x")
+    def Seeked(self, position):
+        pass
+
+    @dbus.service.method(
+        dbus_interface=TRACKLIST_IFACE, in_signature="ao", out_signature="aa{sv}"
+    )
+    def GetTracksMetadata(self, ids):
+        result = []
+        for track_id in ids:
+            with self._lock:
+                track = self._tracks.get(str(track_id))
+            if track:
+                result.append(self._track_metadata(track.info, track_id, cover=False))
+        return dbus.Array(result, signature="a{sv}")
+
+    @dbus.service.method(
+        dbus_interface=TRACKLIST_IFACE, in_signature="sob", out_signature=""
+    )
+    def AddTrack(self, uri, after, current):
+        pass
+
+    @dbus.service.method(
+        dbus_interface=TRACKLIST_IFACE, in_signature="o", out_signature=""
+    )
+    def RemoveTrack(self, track_id):
+        pass
+
+    @dbus.service.method(
+        dbus_interface=TRACKLIST_IFACE, in_signature="o", out_signature=""
+    )
+    def GoTo(self, track_id):
+        with self._lock:
+            track = self._tracks.get(str(track_id))
+        if track:
+            self.remote.go_to(track)
+
+    @dbus.service.signal(dbus_interface=TRACKLIST_IFACE, signature="aoo")
+    def TrackListReplaced(self, tracks, current):
+        pass
+
+    @dbus.service.signal(dbus_interface=TRACKLIST_IFACE, signature="a{sv}o")
+    def TrackAdded(self, metadata, after):
+        pass
+
+    @dbus.service.signal(dbus_interface=TRACKLIST_IFACE, signature="o")
+    def TrackRemoved(self, track_id):
+        pass
+
     def track_paused(self, track):
+        self._update_clock()
         self._update_player_props()
 
     def track_playing(self, track):
-        self._set_cover(track)
+        self._update_clock()
         self._update_player_props()
 
     def track_changed(self, track):
+        self._set_clock(0, app.get().playlist.is_playing())
+        self._update_track_list()
         if not app.get().playlist.is_playing():
             self._update_player_props()
 
+    def playlist_changed(self):
+        self._update_track_list()
+
     def track_position_changed(self, track, position):
-        update = {
-            "Position": dbus.Int64(position * 1000),
-        }
-        self.props[PLAYER_IFACE].update(update)
-        self.PropertiesChanged(PLAYER_IFACE, update, [])
+        self._set_clock(position, app.get().playlist.is_playing())
+
+    def track_seeked(self, track, position):
+        # Per the MPRIS spec, position is not signalled as it changes during playback;
+        # clients query it when needed, and are only told about jumps.
+        self._set_clock(position, app.get().playlist.is_playing())
+        self.counts["Seeked"] += 1
+        self._emit(self.Seeked, dbus.Int64(position * 1000))
+
+    def ui_exit(self):
+        self.report()
+
+    def report(self):
+        ticks = app.get().playlist.player().positions.ticks
+        print(
+            f"mpris: {self.counts['PropertiesChanged']} PropertiesChanged signals "
+            f"with {self.counts['properties']} values, {self.counts['unchanged']} "
+            f"unchanged updates skipped, {self.counts['Seeked']} Seeked signals, "
+            f"{self.counts['TrackAdded']} TrackAdded, "
+            f"{self.counts['TrackRemoved']} TrackRemoved, "
+            f"{self.counts['TrackListReplaced']} TrackListReplaced; "
+            f"{ticks} position PropertiesChanged signals avoided"
+        )
 
     def track_stopped(self, track):
+        self._set_clock(0, False)
         self._update_player_props()
 
-    def _update_player_props(self, emit=True):
+    def _update_player_props(self):
         pl = app.get().playlist
 
         state = "Stopped"
@@ -193,34 +278,172 @@ class MPRIS(dbus.service.Object, util.Listener):
             state = "Playing"
         elif pl.is_paused():
             state = "Paused"
-        track = pl.player().track()
 
-        meta = dbus.Dictionary({}, signature="sv")
-        if track:
-            meta.update(
-                {
-                    "mpris:trackid": f"{remote.DBUS_OBJECT}/{track.trackno}",
-                    "mpris:length": dbus.Int64(track.duration_ms),
-                    "xesam:album": track.album,
-                    "xesam:artist": track.artist,
-                    "xesam:title": track.title,
-                }
-            )
+        track = pl.player().track()
+        if track is not self._meta_track or self._metadata is None:
+            self._meta_track = track
+            self._metadata = dbus.Dictionary({}, signature="sv")
+            if track:
+                current = pl.current_track()
+                if current and current.info is track:
+                    track_id = self._track_id(current)
+                else:
+                    track_id = NO_TRACK
+                self._metadata = self._track_metadata(track, track_id)
+
+        self._changed(
+            PLAYER_IFACE,
+            {
+                "PlaybackStatus": state,
+                "Metadata": self._metadata,
+            },
+        )
+
+    def _track_metadata(self, track, track_id, cover=True):
+        meta = dbus.Dictionary(
+            {
+                "mpris:trackid": dbus.ObjectPath(track_id),
+                "mpris:length": dbus.Int64(track.duration_ms * 1000),
+                "xesam:album": track.album,
+                "xesam:artist": dbus.Array([track.artist], signature="s"),
+                "xesam:title": track.title,
+                "xesam:trackNumber": dbus.Int32(track.trackno),
+            },
+            signature="sv",
+        )
 
+        if cover:
             self._set_cover(track)
             if self._cover_uri:
                 meta["mpris:artUrl"] = self._cover_uri
+        return meta
+
+    def _track_id(self, track):
+        with self._lock:
+            track_id = self._ids.get(track)
+            if not track_id:
+                track_id = f"{TRACK_PATH}/{self._next_id}"
+                self._next_id += 1
+                self._ids[track] = track_id
+                self._tracks[track_id] = track
+            return track_id
+
+    def _queued_ids(self):
+        pl = app.get().playlist
+        ids = []
+        start = max(pl.track_idx, 0)
+        for album in pl.albums:
+            for t in album.tracks[start:]:
+                if not t.should_skip():
+                    ids.append(self._track_id(t))
+            start = 0
+        return ids
+
+    def _set_tracks_prop(self):
+        with self._lock:
+            tracks = dict(
+                self.props[TRACKLIST_IFACE],
+                Tracks=dbus.Array(self._track_list, signature="o"),
+            )
+            self.props = dict(self.props, **{TRACKLIST_IFACE: tracks})
+
+    def _update_track_list(self):
+        """
+        Sends the changes in the track list since the last update.
+        """
+        old = self._track_list
+        new = self._queued_ids()
+        if new == old:
+            return
 
-        props = {
-            "PlaybackStatus": state,
-            "Position": dbus.Int64(0),
-            "Metadata": meta,
-        }
+        self._track_list = new
+        self._set_tracks_prop()
+
+        old_ids = set(old)
+        new_ids = set(new)
+        removed = [t for t in old if t not in new_ids]
+        added = [i for i, t in enumerate(new) if t not in old_ids]
+        if len(removed) + len(added) > MAX_TRACK_SIGNALS or not old_ids & new_ids:
+            current = new[0] if new else NO_TRACK
+            self.counts["TrackListReplaced"] += 1
+            self._emit(
+                self.TrackListReplaced,
+                dbus.Array(new, signature="o"),
+                dbus.ObjectPath(current),
+            )
+            return
+
+        for track_id in removed:
+            self.counts["TrackRemoved"] += 1
+            self._emit(self.TrackRemoved, dbus.ObjectPath(track_id))
+
+        for i in added:
+            with self._lock:
+                track = self._tracks[new[i]]
+            after = new[i - 1] if i else NO_TRACK
+            self.counts["TrackAdded"] += 1
+            self._emit(
+                self.TrackAdded,
+                self._track_metadata(track.info, new[i], cover=False),
+                dbus.ObjectPath(after),
+            )
+
+    def _changed(self, iface, props):
+        """
+        Updates the snapshot with the given property values, and queues a change
+        signal for the ones that are different.
+        """
+        with self._lock:
+            current = self.props[iface]
+            props = {k: v for k, v in props.items() if current.get(k) != v}
+            if props:
+                self.props = dict(self.props, **{iface: dict(current, **props)})
+
+        if not props:
+            self.counts["unchanged"] += 1
+            return
+
+        self._pending.setdefault(iface, {}).update(props)
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            QTimer.singleShot(0, self._flush)
+
+    def _flush(self):
+        self._flush_scheduled = False
+        pending = self._pending
+        self._pending = {}
+        for iface, props in pending.items():
+            # Values may have gone back to what was last sent before the flush.
+            emitted = self._emitted.setdefault(iface, {})
+            changed = {k: v for k, v in props.items() if emitted.get(k) != v}
+            if changed:
+                emitted.update(changed)
+                self.counts["PropertiesChanged"] += 1
+                self.counts["properties"] += len(changed)
+                self._emit(self.PropertiesChanged, iface, changed, [])
+
+    def _emit(self, signal, *args):
+        # Signals are sent from the IPC thread, like all other D-Bus traffic.
+        def emit():
+            signal(*args)
+            return False
+
+        GLib.idle_add(emit)
+
+    def _update_clock(self):
+        pl = app.get().playlist
+        self._set_clock(pl.player().position(), pl.is_playing())
 
-        self.props[PLAYER_IFACE].update(props)
+    def _set_clock(self, position, playing):
+        with self._lock:
+            self._clock = (position, time.monotonic(), playing)
 
-        if emit:
-            self.PropertiesChanged(PLAYER_IFACE, props, [])
+    def _position(self):
+        with self._lock:
+            position, at, playing = self._clock
+        if playing:
+            position += (time.monotonic() - at) * 1000
+        return dbus.Int64(int(position) * 1000)
 
     def _set_cover(self, track):
         album = os.path.dirname(track.path)
@@ -233,17 +456,26 @@ class MPRIS(dbus.service.Object, util.Listener):
             except:
                 pass
 
+        self._cover_path = None
+        self._cover_uri = None
         art = track.cover_art()
         if art:
             self._cover_path = os.path.join(self._covers_dir, str(uuid.uuid4()))
             self._cover_uri = pathlib.Path(self._cover_path).as_uri()
             open(self._cover_path, "wb").write(art)
 
-        self._cover_album = track.album
+        self._cover_album = album
 
 
 class Server(dbus.service.Object):
+    """
+    The D-Bus services. They run on a GLib main loop in a separate thread, which Qt
+    is kept from also dispatching (see `app.init`); commands are forwarded to the
+    GUI thread.
+    """
+
     def __init__(self, ui):
+        threads_init()
         DBusGMainLoop(set_as_default=True)
         bus = dbus.SessionBus()
 
@@ -260,8 +492,13 @@ class Server(dbus.service.Object):
         bus_name = dbus.service.BusName(remote.DBUS_SERVICE, bus=bus)
         dbus.service.Object.__init__(self, bus, remote.DBUS_OBJECT, bus_name=bus_name)
         self.ui = ui
-        self.remote = Remote(self.ui)
+        self.remote = util.GuiProxy(control.Remote(self.ui))
         self.mpris = MPRIS(bus, self.remote)
+        control.REPORTS.append(self.mpris.report)
+
+        self._loop = GLib.MainLoop()
+        self._thread = threading.Thread(target=self._loop.run, name="ipc", daemon=True)
+        self._thread.start()
 
     @dbus.service.method(
         dbus_interface=remote.REMOTE_CONTROL_IFACE, in_signature="", out_signature=""
@@ -297,12 +534,16 @@ class Server(dbus.service.Object):
         dbus_interface=remote.REMOTE_CONTROL_IFACE, in_signature="", out_signature=""
     )
     def stop_after_track(self):
-        value = app.get().playlist.stop_after(app.get().playlist.current_track())
-        text = "On" if value else "Off"
-        osd.show_msg(f"Stop After Track: {text}")
+        self.remote.stop_after_track()
 
     @dbus.service.method(
         dbus_interface=remote.REMOTE_CONTROL_IFACE, in_signature="", out_signature=""
     )
     def osd(self):
-        osd.show_track(None)
+        self.remote.osd()
+
+    @dbus.service.method(
+        dbus_interface=remote.REMOTE_CONTROL_IFACE, in_signature="", out_signature=""
+    )
+    def stats(self):
+        self.remote.stats()
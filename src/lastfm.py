@@ -1,11 +1,16 @@
 # SPDX-License-Identifier: BSD-2-Clause
+import collections
 import hashlib
 import http
+import itertools
+import json
 import os
+import random
 import re
 import sys
 import threading
 import time
+import uuid
 from xml.dom import minidom
 
 import requests
@@ -17,52 +22,269 @@ API_URL = "https://ws.audioscrobbler.com/2.0/"
 
 SETTINGS_GRP = "last.fm"
 SETTINGS_SESSION_KEY = "session_key"
+SETTINGS_API_URL = "api_url"
+
+# Overrides the API endpoint, e.g. to point at a local test server.
+API_URL_ENV = "FOLDERME_LASTFM_URL"
 
 MULTI_DISC_RE = re.compile(r"(.*)\s+\(Disc [0-9]+\)")
 
+# Maximum number of tracks accepted by a single track.scrobble call.
+BATCH_SIZE = 50
+
+# API errors worth retrying later: operation failed, service offline, temporary
+# error, rate limit exceeded.
+TRANSIENT_ERRORS = {8, 11, 16, 29}
+
+# API errors that affect every request until the user re-authorizes: authentication
+# failed, invalid session key, invalid API key, suspended API key.
+AUTH_ERRORS = {4, 9, 10, 26}
+
+# Retry delays after failures, in seconds.
+MIN_BACKOFF = 1
+MAX_BACKOFF = 600
+
+SHUTDOWN_TIMEOUT = 2
+
+# Tracks are only scrobbled if longer than MIN_TRACK_MS, and played for half their
+# length or SCROBBLE_PLAYED_MS, whichever comes first.
+MIN_TRACK_MS = 30 * 1000
+SCROBBLE_PLAYED_MS = 4 * 60 * 1000
+
+# How long a track must keep playing before it is reported as "now playing", so
+# that skipping through tracks does not send an update for each.
+NOW_PLAYING_DELAY = 5
+
+ERROR_CODE_RE = re.compile(r'<error code="([0-9]+)"')
+
+_SESSION = None
+
+
+class LastFmError(Exception):
+    def __init__(self, message, code=None, status=None):
+        super().__init__(message)
+        self.code = code
+        self.status = status
+
+    @property
+    def transient(self):
+        # Only errors reported by the API itself are known to be permanent. Anything
+        # else, e.g. a proxy answering 403 or 407, may go away on its own.
+        if self.code is not None:
+            return self.code in TRANSIENT_ERRORS
+        return True
+
+
+def api_url():
+    return os.environ.get(API_URL_ENV) or util.SETTINGS.value(
+        f"{SETTINGS_GRP}/{SETTINGS_API_URL}", API_URL
+    )
+
+
+def _session():
+    global _SESSION
+    if not _SESSION:
+        _SESSION = requests.Session()
+    return _SESSION
+
 
 def _check_response(res):
-    if res.status_code != http.HTTPStatus.OK:
-        raise Exception(f"Error: {res.status_code} {res.text}")
+    code = None
+    message = res.text
+    if res.headers.get("content-type", "").startswith("application/json"):
+        try:
+            data = res.json()
+        except ValueError:
+            data = None
+        if isinstance(data, dict) and "error" in data:
+            code = int(data["error"])
+            message = data.get("message")
+    else:
+        m = ERROR_CODE_RE.search(res.text)
+        if m:
+            code = int(m.group(1))
+
+    if code is not None or res.status_code != http.HTTPStatus.OK:
+        raise LastFmError(
+            f"Error: {res.status_code} {code} {message}", code, res.status_code
+        )
 
 
 class Scrobble:
     def __init__(self):
         self.artist = None
         self.album = None
+        self.title = None
         self.timestamp = None
         self.is_ended = False
         self.start_time = None
 
+    def record(self):
+        return {
+            "artist": self.artist,
+            "album": self.album,
+            "title": self.title,
+            "ended": self.is_ended,
+            "start": self.start_time,
+        }
 
-class ScrobbleCache(util.ConfigObj):
-    def __init__(self):
-        self.scrobbles = []
+    @classmethod
+    def from_record(cls, record):
+        s = cls()
+        s.artist = record["artist"]
+        s.album = record["album"]
+        s.title = record["title"]
+        s.is_ended = record["ended"]
+        s.start_time = record["start"]
+        return s
 
-    def is_empty(self):
-        return len(self.scrobbles) == 0
 
-    def next(self):
-        return self.scrobbles[0] if self.scrobbles else None
+class ScrobbleCache:
+    """
+    Queue of scrobbles waiting to be submitted, kept in a journal with a separate
+    acknowledgement of how much of it was submitted.
+    """
 
-    def pop(self):
-        if self.scrobbles:
-            del self.scrobbles[0]
-            self.save()
+    NAME = "lastfm.scrobbles"
+    COMPACT_RECORDS = 1000
+
+    def __init__(self):
+        self._journal = util.Journal(self.NAME)
+        self._ack_path = os.path.join(util.config_dir(), f"{self.NAME}.ack")
+        self._lock = threading.Lock()
+        self._scrobbles = collections.deque()
+        self._id = None
+        self._acked = 0
+        self._compacting = False
+
+    @classmethod
+    def load(cls):
+        cache = cls()
+        try:
+            cache._load()
+        except Exception:
+            print("Error reading scrobble journal, pending scrobbles may be lost.")
+            util.print_error()
+        cache._migrate()
+        return cache
+
+    def is_empty(self):
+        return not self._scrobbles
+
+    def next(self, count=1):
+        with self._lock:
+            return list(itertools.islice(self._scrobbles, count))
+
+    def pop(self, count=1):
+        with self._lock:
+            count = min(count, len(self._scrobbles))
+            for _ in range(count):
+                self._scrobbles.popleft()
+            self._acked += count
+            self._write_ack()
+
+            compact = (
+                not self._compacting
+                and self._acked >= self.COMPACT_RECORDS
+                and self._acked * 2 >= self._journal.count
+            )
+            self._compacting |= compact
+
+        if compact:
+            threading.Thread(
+                target=self._compact, name="scrobble-compact", daemon=True
+            ).start()
 
     def add(self, s):
-        self.scrobbles.append(s)
-        self.save()
+        with self._lock:
+            if self._id is None:
+                self._id = uuid.uuid4().hex
+                self._journal.append("start", id=self._id)
+            self._journal.append("add", **s.record())
+            self._scrobbles.append(s)
+
+    def _load(self):
+        ack = {}
+        if os.path.isfile(self._ack_path):
+            with open(self._ack_path, encoding="utf-8") as f:
+                ack = json.load(f)
+
+        skip = 0
+        for record in self._journal.replay():
+            if record["op"] == "start":
+                self._id = record["id"]
+                skip = ack.get("acked", 0) if ack.get("id") == self._id else 0
+            elif skip:
+                skip -= 1
+                self._acked += 1
+            else:
+                self._scrobbles.append(Scrobble.from_record(record))
+
+    def _migrate(self):
+        # Import the queue saved by older versions, which rewrote the whole list on
+        # every change.
+        path = os.path.join(util.config_dir(), "lastfm.ScrobbleCache")
+        if not os.path.isfile(path) or not util.ConfigObj.SAVE_ENABLED:
+            return
+
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        for s in data.get("scrobbles", []):
+            self.add(
+                Scrobble.from_record(
+                    {
+                        "artist": s.get("artist"),
+                        "album": s.get("album"),
+                        "title": s.get("title"),
+                        "ended": s.get("is_ended", False),
+                        "start": s.get("start_time"),
+                    }
+                )
+            )
+        os.unlink(path)
+
+    def _write_ack(self):
+        if util.ConfigObj.SAVE_ENABLED:
+            util.atomic_write(
+                self._ack_path, json.dumps({"id": self._id, "acked": self._acked})
+            )
+
+    def _compact(self):
+        with self._lock:
+            try:
+                new_id = uuid.uuid4().hex
+                records = [("start", {"id": new_id})]
+                records.extend(("add", s.record()) for s in self._scrobbles)
+                self._journal.rewrite(records)
+                self._id = new_id
+                self._acked = 0
+                self._write_ack()
+            except Exception:
+                print("Error compacting scrobble journal.")
+                util.print_error()
+            finally:
+                self._compacting = False
 
 
 class Scrobbler(util.Listener):
+    # Cache updates write to disk, so keep them off the GUI thread. Allow for a deep
+    # queue since dropped events mean lost scrobbles.
+    ASYNC = True
+    ASYNC_QUEUE_DEPTH = 1024
+
     def __init__(self, session_key, enabled):
         self.cond = threading.Condition()
         self.cache = ScrobbleCache.load()
         self.session_key = session_key
         self.enabled = enabled
 
+        self._track = None
         self._playback_start = None
+        self._played = util.PlayedTime()
+        self._now_playing = None
+        self._now_playing_at = 0
+        self._failures = 0
+        self._offline = False
         self.running = True
 
         self.thread = threading.Thread(target=self._run, daemon=True)
@@ -70,71 +292,224 @@ class Scrobbler(util.Listener):
 
     def _run(self):
         while self.running:
+            now_playing = None
             with self.cond:
                 while self.running and self.cache.is_empty():
-                    self.cond.wait()
-
-                next = self.cache.next()
-
-            if next is not None:
-                try:
-                    self._scrobble(next)
+                    # Only send "now playing" updates when there is no backlog.
+                    timeout = None
+                    if self._now_playing:
+                        timeout = self._now_playing_at - time.monotonic()
+                        if timeout <= 0:
+                            now_playing = self._now_playing
+                            self._now_playing = None
+                            break
+                    self.cond.wait(timeout)
+
+                pending = self.cache.next(BATCH_SIZE)
+
+            if not pending and not now_playing:
+                continue
+
+            try:
+                if pending:
+                    count = self._submit(pending)
                     with self.cond:
-                        self.cache.pop()
-                except Exception as e:
-                    print(f"error scrobbling: {e}", file=sys.stderr)
-
-    def _scrobble(self, s):
+                        self.cache.pop(count)
+                else:
+                    self._send_now_playing(now_playing)
+                self._online()
+            except requests.RequestException as e:
+                self._backoff(f"network error: {e}")
+            except LastFmError as e:
+                if e.code in AUTH_ERRORS:
+                    print(
+                        f"last.fm: {e}; scrobbling disabled until re-authorized.",
+                        file=sys.stderr,
+                    )
+                    self._park(None)
+                else:
+                    self._backoff(str(e))
+            except Exception as e:
+                self._backoff(f"error scrobbling: {e}")
+
+    def _online(self):
+        if self._offline:
+            print("last.fm: back online.")
+        self._offline = False
+        self._failures = 0
+
+    def _backoff(self, error):
+        """
+        Waits before the next attempt, doubling the wait (with some jitter) after
+        each consecutive failure. Errors are only logged when going offline, not on
+        every retry.
+        """
+        delay = min(MAX_BACKOFF, MIN_BACKOFF * 2**self._failures)
+        delay = random.uniform(delay / 2, delay)
+        self._failures += 1
+        if not self._offline:
+            print(f"last.fm: {error}; retrying in the background.", file=sys.stderr)
+            self._offline = True
+        self._park(time.monotonic() + delay)
+
+    def _park(self, deadline):
+        # New scrobbles also notify the condition, so keep waiting until the
+        # deadline (or forever) unless shutting down.
+        with self.cond:
+            while self.running:
+                timeout = deadline - time.monotonic() if deadline else None
+                if timeout is not None and timeout <= 0:
+                    break
+                self.cond.wait(timeout)
+
+    def _submit(self, pending):
+        """
+        Submits the completed tracks in `pending` in one request, returning how many
+        queue entries are done with, including dropped stale or rejected ones.
+        """
+        batch = [s for s in pending if s.is_ended]
+        try:
+            if batch:
+                self._scrobble(batch)
+        except LastFmError as e:
+            if e.transient or e.code in AUTH_ERRORS:
+                raise
+            print(f"last.fm: dropping {len(pending)} entries: {e}", file=sys.stderr)
+        return len(pending)
+
+    def _send_now_playing(self, s):
+        print(f"last.fm: track.updateNowPlaying {s.artist} / {s.title}")
+        if self.enabled:
+            _post(
+                method="track.updateNowPlaying",
+                api_key=API_KEY,
+                sk=self.session_key,
+                **self._track_info(s),
+            )
+
+    def _scrobble(self, batch):
+        info = {}
+        for i, s in enumerate(batch):
+            print(f"last.fm: track.scrobble {s.artist} / {s.title}")
+            for k, v in self._track_info(s).items():
+                info[f"{k}[{i}]"] = v
+            info[f"timestamp[{i}]"] = str(s.start_time)
+
+        if not self.enabled:
+            return
+
+        res = _post(
+            method="track.scrobble",
+            api_key=API_KEY,
+            sk=self.session_key,
+            format="json",
+            **info,
+        ).json()
+        result = res["scrobbles"]
+        attr = result["@attr"]
+        if int(attr["ignored"]):
+            # Ignored scrobbles are rejected for good (e.g. a bad timestamp), so they
+            # are not retried.
+            items = result["scrobble"]
+            if not isinstance(items, list):
+                items = [items]
+            for item in items:
+                ignored = item["ignoredMessage"]
+                if int(ignored["code"]):
+                    track = item["track"]["#text"]
+                    print(f"last.fm: scrobble ignored ({ignored['code']}): {track}")
+        print(f"last.fm: {attr['accepted']} accepted, {attr['ignored']} ignored")
+
+    def _track_info(self, s):
         album = s.album
         m = MULTI_DISC_RE.match(album)
         if m:
             album = m.group(1)
 
-        info = {
+        return {
             "artist": s.artist,
             "album": album,
             "track": s.title,
-            "api_key": API_KEY,
-            "sk": self.session_key,
         }
 
-        if s.is_ended:
-            info["timestamp"] = str(s.start_time)
-            method = "track.scrobble"
-        else:
-            method = "track.updateNowPlaying"
-        info["method"] = method
-
-        print(f"last.fm: {method} {s.artist} / {s.title}")
-        if self.enabled:
-            _post(**info)
-
-    def _enqueue(self, track, is_ended):
+    def _make_scrobble(self, track, is_ended):
         s = Scrobble()
         s.artist = track.artist
         s.album = track.album
         s.title = track.title
         s.is_ended = is_ended
         s.start_time = self._playback_start
+        return s
+
+    def _finish(self):
+        """
+        Queues a scrobble for the current track if it was played for long enough.
+        """
+        track = self._track
+        self._track = None
+        if not track:
+            return
+
+        with self.cond:
+            # Not sent yet, and no longer playing.
+            self._now_playing = None
+
+        duration = track.duration_ms
+        if duration <= MIN_TRACK_MS or self._played.ms < min(
+            duration / 2, SCROBBLE_PLAYED_MS
+        ):
+            print(
+                f"last.fm: not scrobbling {track.artist} / {track.title}, played "
+                f"{self._played.ms // 1000}s"
+            )
+            return
+
+        s = self._make_scrobble(track, True)
         with self.cond:
             self.cache.add(s)
             self.cond.notify_all()
 
     def track_playing(self, track):
-        if not self._playback_start:
-            self._playback_start = int(time.time())
-            self._enqueue(track, False)
+        if track is self._track:
+            # Resuming after a pause.
+            return
+
+        self._finish()
+        self._track = track
+        self._playback_start = int(time.time())
+        self._played.reset()
+
+        s = self._make_scrobble(track, False)
+        with self.cond:
+            self._now_playing = s
+            self._now_playing_at = time.monotonic() + NOW_PLAYING_DELAY
+            self.cond.notify_all()
+
+    def track_position_changed(self, track, position):
+        if track is not self._track:
+            return
+        self._played.update(position)
 
     def track_ended(self, track):
-        self._enqueue(track, True)
-        self._playback_start = None
+        if track is self._track:
+            # Account for the part played since the last position update.
+            self.track_position_changed(track, track.duration_ms)
+            self._finish()
+
+    def track_changed(self, track):
+        if track is not self._track:
+            self._finish()
+
+    def track_stopped(self, track):
+        self._finish()
 
     def shutdown(self):
         with self.cond:
             self.running = False
             self.cond.notify_all()
-        self.thread.join()
-        self.cache.save()
+        # A request may be in flight; anything not acknowledged by then is sent again
+        # on the next start.
+        self.thread.join(SHUTDOWN_TIMEOUT)
 
 
 def get_scrobbler(enabled):
@@ -143,7 +518,8 @@ def get_scrobbler(enabled):
 
 
 def sign(params):
-    keys = list(params.keys())
+    # The response format is not part of the signature.
+    keys = [k for k in params.keys() if k not in ("format", "callback")]
     keys.sort()
 
     data = []
@@ -158,13 +534,13 @@ def sign(params):
 
 
 def _get(**params):
-    res = requests.get(API_URL, sign(params))
+    res = _session().get(api_url(), params=sign(params), timeout=5)
     _check_response(res)
     return res
 
 
 def _post(**params):
-    res = requests.post(API_URL, data=sign(params), timeout=5)
+    res = _session().post(api_url(), data=sign(params), timeout=5)
     _check_response(res)
     return res
 
@@ -1,5 +1,7 @@
 # SPDX-License-Identifier: BSD-2-Clause
+import collections
 import os
+import time
 
 import util
 from PySide6.QtCore import QTimer
@@ -9,53 +11,331 @@ from PySide6.QtMultimedia import QMediaPlayer
 from PySide6.QtWidgets import QAbstractSlider
 
 
+class PositionChannel:
+    """
+    Delivers playback position updates to each subscriber at its own rate, and only
+    while its optional `active` callable returns True.
+    """
+
+    class Subscriber:
+        def __init__(self, name, callback, interval_ms, active):
+            self.name = name
+            self.callback = callback
+            self.interval = interval_ms / 1000
+            self.active = active
+            self.delivered = 0
+            self._last = 0
+
+        def offer(self, track, position, now, force):
+            if not force and now - self._last < self.interval:
+                return
+            if self.active and not self.active():
+                return
+
+            self._last = now
+            self.delivered += 1
+            try:
+                self.callback(track, position)
+            except:
+                util.print_error()
+
+    def __init__(self):
+        self._subscribers = []
+        self.ticks = 0
+        self.played = util.PlayedTime()
+
+    def subscribe(self, name, callback, interval_ms, active=None):
+        self._subscribers.append(
+            PositionChannel.Subscriber(name, callback, interval_ms, active)
+        )
+
+    def update(self, track, position, force=False):
+        self.played.update(position)
+        self.ticks += 1
+
+        now = time.monotonic()
+        for s in self._subscribers:
+            s.offer(track, position, now, force)
+
+    def report(self):
+        hours = self.played.ms / 3600000
+        if not hours:
+            return
+
+        print(
+            f"position: {self.ticks} updates from the player in {hours:.2f}h of "
+            f"playback ({self.ticks / hours:.0f}/h)"
+        )
+        for s in self._subscribers:
+            saved = self.ticks - s.delivered
+            print(
+                f"position: {s.name}: {s.delivered} delivered, "
+                f"{saved / hours:.0f}/h wakeups saved"
+            )
+
+
+class StartTrace:
+    """
+    Timestamps of the stages a track goes through until it starts playing.
+    """
+
+    STAGES = ["play", "source set", "loaded", "delayed play", "position set", "playing"]
+
+    def __init__(self, track, mode):
+        self.track = track
+        self.mode = mode
+        self.loads = 0
+        self.times = {}
+        self.mark("play")
+
+    def mark(self, stage):
+        if stage not in self.times:
+            self.times[stage] = time.monotonic()
+
+    def group(self):
+        ext = os.path.splitext(self.track.path)[1].lower().lstrip(".")
+        return f"{ext or '?'} on {_mount_point(self.track.path)}, {self.mode}"
+
+
+class StartStats:
+    """
+    Aggregates track start traces into latency histograms per file format, storage
+    location and whether the file was preloaded / prefetched.
+    """
+
+    # Starts that take longer than this are reported as stalled.
+    STALL_MS = 10000
+
+    def __init__(self):
+        self._totals = collections.defaultdict(util.Histogram)
+        self._stages = collections.defaultdict(util.Histogram)
+        self._bounces = collections.Counter()
+        self._stalled = collections.Counter()
+
+    def finish(self, trace):
+        group = trace.group()
+        total = (trace.times["playing"] - trace.times["play"]) * 1000
+        self._totals[group].add(total)
+        if trace.loads > 1:
+            self._bounces[group] += 1
+
+        prev = None
+        for stage in StartTrace.STAGES:
+            if stage not in trace.times:
+                continue
+            if prev:
+                elapsed = (trace.times[stage] - trace.times[prev]) * 1000
+                self._stages[(group, f"{prev} -> {stage}")].add(elapsed)
+            prev = stage
+
+        print(f"track start ({group}) took {total:.1f} ms")
+
+    def stalled(self, trace):
+        group = trace.group()
+        self._stalled[group] += 1
+        stages = ", ".join(trace.times.keys())
+        print(f"track {trace.track.path} did not start; reached: {stages}")
+
+    def report(self):
+        for group, hist in sorted(self._totals.items()):
+            print(f"track starts ({group}): {hist}")
+            for (g, stage), stage_hist in sorted(self._stages.items()):
+                if g == group:
+                    print(f"  {stage}: {stage_hist}")
+            if self._bounces[group]:
+                print(f"  loading/loaded bounces: {self._bounces[group]}")
+        for group, count in sorted(self._stalled.items()):
+            print(f"track starts ({group}): {count} stalled")
+
+
+_MOUNTS = {}
+
+
+def _mount_point(path):
+    path = os.path.dirname(os.path.abspath(path))
+    if path in _MOUNTS:
+        return _MOUNTS[path]
+
+    mount = path
+    while not os.path.ismount(mount):
+        mount = os.path.dirname(mount)
+    _MOUNTS[path] = mount
+    return mount
+
+
 class Player:
     """
-    Player encapsulates playing a single file.
+    Player encapsulates playing a single file, preloading the next one on a second
+    backend player for gapless transitions.
     """
 
+    PRELOAD_MS = 5000
+
     def __init__(self, parent):
-        self._player = QMediaPlayer(parent)
-        self._output = QAudioOutput(parent)
-        self._player.setAudioOutput(self._output)
-        self._player.mediaStatusChanged.connect(self._handleMediaChange)
-        self._player.playbackStateChanged.connect(self._handlePlaybackChange)
-        self._player.positionChanged.connect(self._handlePositionChange)
+        self._outputs = []
+        self._players = [self._create_player(parent) for _ in range(2)]
+        self._player = self._players[0]
         self._track = None
         self._play_on_load = False
+        self._preloaded = None
+        self._preload_checked = False
+        self._handoff = None
+        self._ended_at = None
+        self._gapless = False
+
+        self._trace = None
+
+        self.next_track = lambda: None
+        self.is_prefetched = lambda path: False
+        self.gaps = {"preloaded": util.Histogram(), "cold": util.Histogram()}
+        self.starts = StartStats()
+        self.positions = PositionChannel()
+        self.positions.subscribe("event bus", self._send_position, 1000)
+
+    def _create_player(self, parent):
+        player = QMediaPlayer(parent)
+        output = QAudioOutput(parent)
+        player.setAudioOutput(output)
+        player.mediaStatusChanged.connect(lambda s: self._handleMediaChange(player, s))
+        player.playbackStateChanged.connect(
+            lambda s: self._handlePlaybackChange(player, s)
+        )
+        player.positionChanged.connect(lambda p: self._handlePositionChange(player, p))
+        self._outputs.append(output)
+        return player
+
+    def _spare(self):
+        return (
+            self._players[1] if self._player is self._players[0] else self._players[0]
+        )
+
+    def _handleMediaChange(self, player, status):
+        if player is not self._player:
+            return
 
-    def _handleMediaChange(self, status):
         title = None
         if self._track:
             title = self._track.title
         print(f"media: {status} {title}")
         if status == QMediaPlayer.EndOfMedia:
-            util.EventBus.send(util.Listener.track_ended, self._track)
+            self._ended_at = time.monotonic()
+            ended = self._track
+            if self._preloaded and self._preloaded is self.next_track():
+                self._switch(ended)
+            else:
+                util.EventBus.send(util.Listener.track_ended, ended)
         elif status == QMediaPlayer.LoadedMedia:
+            if self._trace:
+                self._trace.mark("loaded")
             if self._play_on_load:
                 QTimer.singleShot(0, self._delayed_play)
+        elif status == QMediaPlayer.LoadingMedia:
+            if self._trace:
+                self._trace.loads += 1
+
+    def _handlePlaybackChange(self, player, status):
+        if player is not self._player:
+            return
 
-    def _handlePlaybackChange(self, status):
         print(f"playback state: {status}")
         if status == QMediaPlayer.PlayingState:
+            self._record_gap()
+            if self._trace:
+                self._trace.mark("playing")
+                self.starts.finish(self._trace)
+                self._trace = None
             util.EventBus.send(util.Listener.track_playing, self._track)
         elif status == QMediaPlayer.StoppedState:
             util.EventBus.send(util.Listener.track_stopped, self._track)
         elif status == QMediaPlayer.PausedState:
             util.EventBus.send(util.Listener.track_paused, self._track)
 
-    def _handlePositionChange(self, position):
-        util.EventBus.send(util.Listener.track_position_changed, self._track, position)
+    def _handlePositionChange(self, player, position):
+        if player is not self._player:
+            return
+
+        self.positions.update(self._track, position)
+
+        duration = player.duration()
+        if (
+            not self._preload_checked
+            and duration
+            and duration - position <= self.PRELOAD_MS
+        ):
+            self._preload()
+
+    def _send_position(self, track, position):
+        util.EventBus.send(util.Listener.track_position_changed, track, position)
+
+    def _preload(self):
+        self._preload_checked = True
+        track = self.next_track()
+        if track and os.path.isfile(track.path):
+            print(f"Preloading track {track.path}")
+            self._spare().setSource(QUrl.fromLocalFile(track.path))
+            self._preloaded = track
+
+    def _switch(self, ended=None):
+        """
+        Makes the spare player, with the preloaded track, the current one, starting it
+        before listeners are told about the `ended` track and the new one.
+        """
+        previous = self._player
+        self._player = self._spare()
+        self._track = self._preloaded
+        # The playlist has not moved on from the ended track yet; it will call
+        # play() with this one when told about it.
+        self._handoff = self._track if ended else None
+        self._preloaded = None
+        self._preload_checked = False
+        self._gapless = True
+
+        previous.stop()
+        previous.setSource(QUrl())
+        self._start_trace(self._track, "preloaded")
+
+        with util.EventBus.batch():
+            if ended:
+                util.EventBus.send(util.Listener.track_ended, ended)
+            util.EventBus.send(util.Listener.track_changed, self._track)
+            self._play_on_load = True
+            if self._player.mediaStatus() == QMediaPlayer.LoadedMedia:
+                self._delayed_play()
+
+    def _record_gap(self):
+        if not self._ended_at:
+            return
+
+        gap = (time.monotonic() - self._ended_at) * 1000
+        kind = "preloaded" if self._gapless else "cold"
+        self.gaps[kind].add(gap)
+        print(f"track transition ({kind}) took {gap:.1f} ms")
+        self._ended_at = None
+        self._gapless = False
+
+    def _start_trace(self, track, mode):
+        trace = StartTrace(track, mode)
+        self._trace = trace
+        QTimer.singleShot(StartStats.STALL_MS, lambda: self._check_stalled(trace))
+
+    def _check_stalled(self, trace):
+        if trace is self._trace:
+            self.starts.stalled(trace)
+            self._trace = None
 
     def _delayed_play(self):
         # For whatever reason sometimes the underlying player keeps going back and
         # forth between loading and loaded, and calling play() at the wrong time does
         # not work.
+        if self._trace:
+            self._trace.mark("delayed play")
         if self._player.mediaStatus() != QMediaPlayer.LoadedMedia:
             return
 
         # Players seems to not really start unless the position is set first. Weird.
         self.set_position(0)
+        if self._trace:
+            self._trace.mark("position set")
         self._player.play()
         self._play_on_load = False
 
@@ -64,8 +344,20 @@ class Player:
             f"play {track}: state {self._player.playbackState()}, media {self._player.mediaStatus()}"
         )
 
+        if track and track is self._handoff:
+            # Already started by the preloading player.
+            self._handoff = None
+            return
+
+        if track and track is self._preloaded:
+            print(f"Playing preloaded track {track.path}")
+            self._switch()
+            return
+
         if track:
             print(f"Playing track {track.path}")
+            mode = "prefetched" if self.is_prefetched(track.path) else "not prefetched"
+            self._start_trace(track, mode)
             self._play_on_load = True
             self.set_track(track)
 
@@ -76,6 +368,13 @@ class Player:
         else:
             self._delayed_play()
 
+    def is_handing_off(self):
+        """
+        Whether the player already started the next track on its own, and is waiting
+        for `play()` to be called with it.
+        """
+        return self._handoff is not None
+
     def pause(self):
         if self.is_playing():
             self._player.pause()
@@ -93,11 +392,22 @@ class Player:
     def init_ui(self, ui):
         adapter = UIAdapter(ui, self)
         util.EventBus.add(adapter)
-        self._player.durationChanged.connect(adapter.duration_changed)
+        for p in self._players:
+            p.durationChanged.connect(
+                lambda d, p=p: p is self._player and adapter.duration_changed(d)
+            )
 
     def set_position(self, position):
         self._player.setPosition(position)
 
+    def seek(self, position):
+        """
+        Changes the position on behalf of the user, notifying listeners of the jump.
+        """
+        self.set_position(position)
+        self.positions.update(self._track, position, force=True)
+        util.EventBus.send(util.Listener.track_seeked, self._track, position)
+
     def position(self):
         return self._player.position()
 
@@ -107,22 +417,36 @@ class Player:
     def set_track(self, track):
         if os.path.isfile(track.path):
             self._track = track
+            self._preloaded = None
+            self._preload_checked = False
+            self._handoff = None
             self._player.setSource(QUrl.fromLocalFile(track.path))
+            if self._trace and self._trace.track is track:
+                self._trace.mark("source set")
             util.EventBus.send(util.Listener.track_changed, track)
 
+    def report(self):
+        self.positions.report()
+        for kind, hist in self.gaps.items():
+            if hist.count:
+                print(f"track transitions ({kind}): {hist}")
+        self.starts.report()
+
 
 class UIAdapter(util.Listener):
     def __init__(self, ui, player):
         self.ui = ui
         self.player = player
         self.duration = 0
-        self.last_sec = 0
         self._slider_locked = False
 
         self.ui.tPosition.sliderPressed.connect(self.slider_pressed)
         self.ui.tPosition.sliderReleased.connect(self.slider_released)
         self.ui.tPosition.sliderMoved.connect(self.slider_moved)
         self.ui.tPosition.actionTriggered.connect(self.action_triggered)
+        player.positions.subscribe(
+            "ui", self._position_changed, 1000, active=self.ui.isVisible
+        )
 
     def _normalize(self, duration):
         return duration - (duration % 1000)
@@ -160,21 +484,16 @@ class UIAdapter(util.Listener):
         self.ui.tPosition.setMaximum(duration)
         self.duration = duration
 
-    def track_position_changed(self, track, position):
-        if self._slider_locked:
-            return
-
-        sec = position // 1000
-        if sec == self.last_sec:
-            return
-        self._update_position(self._normalize(position))
+    def _position_changed(self, track, position):
+        if not self._slider_locked:
+            self._update_position(position)
 
     def slider_pressed(self):
         self._slider_locked = True
 
     def slider_released(self):
         self._slider_locked = False
-        self.player.set_position(self.ui.tPosition.sliderPosition())
+        self.player.seek(self.ui.tPosition.sliderPosition())
 
         position = self._normalize(self.player.position())
         self.ui.tElapsed.setText(util.ms_to_text(position))
@@ -202,4 +521,4 @@ class UIAdapter(util.Listener):
             return
 
         position = min(max(0, self.ui.tPosition.sliderPosition() + step), self.duration)
-        self.player.set_position(position)
+        self.player.seek(position)
@@ -176,6 +176,8 @@ if __name__ == "__main__":
     args = Args()
     args.no_save = True
     args.no_lastfm = True
+    args.event_stats = False
+    args.no_dbus = True
     app.init(args)
     init()
 
@@ -1,6 +1,9 @@
 # SPDX-License-Identifier: BSD-2-Clause
+import uuid
+
 import app
 import media
+import prefetch
 import util
 from PySide6.QtCore import QTimer
 from PySide6.QtCore import Qt
@@ -20,6 +23,7 @@ class Track:
 
 class Album(util.ConfigObj):
     K_SKIP_TRACKS = "skip"
+    K_STOP_AFTER = "stop_after"
 
     def __init__(self, album=None):
         self._info = album
@@ -41,26 +45,132 @@ class Album(util.ConfigObj):
     def __getstate__(self):
         data = util.ConfigObj.__getstate__(self)
         data[self.K_SKIP_TRACKS] = [t.index for t in self._tracks if t.skip]
+        stop_after = [t.index for t in self._tracks if t.stop_after]
+        if stop_after:
+            data[self.K_STOP_AFTER] = stop_after[0]
         return data
 
     def __setstate__(self, data):
-        skip = data.get(self.K_SKIP_TRACKS, [])
-        if skip:
-            del data[self.K_SKIP_TRACKS]
+        skip = data.pop(self.K_SKIP_TRACKS, [])
+        stop_after = data.pop(self.K_STOP_AFTER, None)
         util.ConfigObj.__setstate__(self, data)
 
         self._info = app.get().collection.get_album(self.path)
         for i in range(len(self.info.tracks)):
             self._tracks.append(Track(self.info.tracks[i], i, skip=i in skip))
+            self._tracks[i].stop_after = i == stop_after
 
 
 class Playlist(util.ConfigObj, util.Listener):
+    """
+    The play queue, saved as a snapshot plus a journal of the changes made since.
+    """
+
+    JOURNAL_LIMIT = 256
+    PREFETCH_TRACKS_KEY = "playlist/prefetch_tracks"
+    PREFETCH_MB_KEY = "playlist/prefetch_mb"
+
     def __init__(self):
         self.albums = []
         self.track_idx = 0
+        self.generation = None
         self._inhibity_play = False
+        self._journal = util.Journal(self.config_file_name())
+        self._journal_started = False
+        self._prefetcher = None
+        self._prefetch_tracks = 0
         util.EventBus.add(self)
 
+    @classmethod
+    def load(cls):
+        playlist = super().load()
+        if not playlist._replay():
+            # Do not replay the same broken or stale records on every start.
+            playlist.save()
+        return playlist
+
+    def _replay(self):
+        """
+        Applies the journal to the snapshot, returning False if any of it had to be
+        skipped.
+        """
+        ok = True
+        try:
+            for i, record in enumerate(self._journal.replay()):
+                if i == 0:
+                    # Journals written before generation ids have no start record.
+                    start = record.get("id") if record["op"] == "start" else None
+                    if start != self.generation:
+                        print("Playlist journal is from another snapshot, skipping it.")
+                        return False
+                    self._journal_started = True
+                    if record["op"] == "start":
+                        continue
+                try:
+                    self._apply(record)
+                except Exception:
+                    print(
+                        f"Error replaying playlist journal record {record}, skipping."
+                    )
+                    util.print_error()
+                    ok = False
+        except Exception:
+            print("Error replaying playlist journal, state may be stale.")
+            util.print_error()
+            return False
+        return ok
+
+    def save(self):
+        if self.SAVE_ENABLED:
+            self.generation = uuid.uuid4().hex
+        util.ConfigObj.save(self)
+        if self.SAVE_ENABLED:
+            self._journal.reset()
+            self._journal_started = False
+
+    def _log(self, op, **args):
+        if not self._journal_started:
+            self._journal.append("start", id=self.generation)
+            self._journal_started = True
+        self._journal.append(op, **args)
+        if self._journal.count >= self.JOURNAL_LIMIT:
+            self.save()
+
+    def _apply(self, record):
+        op = record["op"]
+        if op == "add":
+            self.albums.append(Album(self._find_album(record["path"])))
+        elif op == "replace":
+            self.albums = [Album(self._find_album(record["path"]))]
+            self.track_idx = 0
+        elif op == "remove":
+            del self.albums[record["album"]]
+        elif op == "track":
+            self.track_idx = record["index"]
+        elif op == "skip":
+            track = self.albums[record["album"]].tracks[record["track"]]
+            track.skip = record["skip"]
+        elif op == "stop_after":
+            for a in self.albums:
+                for t in a.tracks:
+                    t.stop_after = False
+            if record["value"]:
+                self.albums[record["album"]].tracks[record["track"]].stop_after = True
+        else:
+            raise Exception(f"Unknown journal record: {record}")
+
+    def _find_album(self, path):
+        album = app.get().collection.get_album(path)
+        if not album:
+            raise Exception(f"Album {path} not found in collection.")
+        return album
+
+    def _album_index(self, track):
+        for i in range(len(self.albums)):
+            if track in self.albums[i].tracks:
+                return i
+        return -1
+
     def playpause(self):
         if self._player.is_playing():
             self._player.pause()
@@ -78,12 +188,28 @@ class Playlist(util.ConfigObj, util.Listener):
 
     def play(self, track):
         self.track_idx = track.index
+        self._log("track", index=self.track_idx)
         if self._inhibity_play:
             self._player.set_track(track=track.info)
             util.EventBus.send(util.Listener.playlist_changed)
         else:
             self._player.play(track=track.info)
 
+    def go_to(self, track):
+        """
+        Plays the given track, dropping the albums queued before its own.
+        """
+        idx = self._album_index(track)
+        if idx < 0:
+            return
+
+        for _ in range(idx):
+            del self.albums[0]
+            self._log("remove", album=0)
+        self.play(track)
+        if idx:
+            util.EventBus.send(util.Listener.playlist_changed)
+
     def is_playing(self):
         return self._player.is_playing()
 
@@ -109,9 +235,29 @@ class Playlist(util.ConfigObj, util.Listener):
                     new_value = False
                 idx += 1
         track.stop_after = new_value
+        self._log(
+            "stop_after",
+            album=self._album_index(track),
+            track=track.index,
+            value=new_value,
+        )
         util.EventBus.send(util.Listener.playlist_changed)
         return new_value
 
+    def set_skip(self, track, skip):
+        track.skip = skip
+        self._log("skip", album=self._album_index(track), track=track.index, skip=skip)
+        util.EventBus.send(util.Listener.playlist_changed)
+
+    def toggle_kill(self, tracks):
+        """
+        Toggles whether the given tracks are always skipped, in any playlist.
+        """
+        for t in tracks:
+            t.info.skip = not t.info.skip
+        app.get().collection.save()
+        util.EventBus.send(util.Listener.playlist_changed)
+
     def next(self):
         while True:
             album = self.albums[0]
@@ -124,6 +270,8 @@ class Playlist(util.ConfigObj, util.Listener):
 
             self.track_idx = -1
             del self.albums[0]
+            self._log("remove", album=0)
+            self._log("track", index=self.track_idx)
             if not self.albums:
                 util.EventBus.send(util.Listener.playlist_ended)
                 return
@@ -138,17 +286,35 @@ class Playlist(util.ConfigObj, util.Listener):
 
     def add(self, album):
         self.albums.append(Album(album))
+        self._log("add", path=album.path)
 
     def replace(self, album, play=False):
         play = play or self.is_playing()
         self.albums = [Album(album)]
         self.track_idx = 0
         self.stop()
-        self.save()
+        self._log("replace", path=album.path)
         util.EventBus.send(util.Listener.playlist_changed)
         if play:
             self.playpause()
 
+    def _peek_next(self):
+        """
+        Returns the info for the track that `next()` would play after the current
+        one, or None if playback should not continue.
+        """
+        track = self.current_track()
+        if not track or track.stop_after:
+            return None
+
+        start = self.track_idx + 1
+        for album in self.albums:
+            for t in album.tracks[start:]:
+                if not t.should_skip():
+                    return t.info
+            start = 0
+        return None
+
     def current_track(self):
         if not self.albums:
             return None
@@ -160,17 +326,33 @@ class Playlist(util.ConfigObj, util.Listener):
 
         if track.stop_after:
             track.stop_after = False
+            self._log(
+                "stop_after",
+                album=self._album_index(track),
+                track=track.index,
+                value=False,
+            )
             self._player.stop()
 
-        QTimer.singleShot(0, self._post_track_ended)
+        if self._player.is_handing_off():
+            # The next track is already playing, move to it before listeners are told
+            # about it.
+            self._post_track_ended()
+        else:
+            QTimer.singleShot(0, self._post_track_ended)
 
     def _post_track_ended(self):
         self.next()
         self._inhibity_play = False
-        self.save()
 
     def init_ui(self, ui):
+        budget = int(util.SETTINGS.value(self.PREFETCH_MB_KEY, 64)) * 1024 * 1024
+        self._prefetcher = prefetch.Prefetcher(budget)
+        self._prefetch_tracks = int(util.SETTINGS.value(self.PREFETCH_TRACKS_KEY, 2))
+
         self._player = media.Player(ui)
+        self._player.next_track = self._peek_next
+        self._player.is_prefetched = self._prefetcher.is_warm
         track = self.current_track()
         if track:
             self._player.set_track(track.info)
@@ -188,9 +370,43 @@ class Playlist(util.ConfigObj, util.Listener):
     def player(self):
         return self._player
 
+    def shutdown(self):
+        if self._prefetcher:
+            self._prefetcher.shutdown()
+            self._prefetcher.report()
+
+    def track_playing(self, track):
+        self._prefetch()
+
+    def playlist_changed(self):
+        self._prefetch()
+
+    def _prefetch(self):
+        """
+        Asks the prefetcher to warm up the next few tracks of the current album, and
+        the first track of the next one.
+        """
+        if not self.albums or not self._prefetcher:
+            # Nothing to do until init_ui() creates the prefetcher.
+            return
+
+        paths = []
+        for t in self.albums[0].tracks[self.track_idx + 1 :]:
+            if len(paths) >= self._prefetch_tracks:
+                break
+            if not t.should_skip():
+                paths.append(t.info.path)
+
+        if len(self.albums) > 1:
+            for t in self.albums[1].tracks:
+                if not t.should_skip():
+                    paths.append(t.info.path)
+                    break
+
+        self._prefetcher.request(paths)
+
     def add_album(self, album):
-        self.albums.append(Album(album))
-        self.save()
+        self.add(album)
         util.EventBus.send(util.Listener.playlist_changed)
 
     def remove_album(self, album):
@@ -200,16 +416,17 @@ class Playlist(util.ConfigObj, util.Listener):
             if a is album:
                 stop = i == 0
                 del self.albums[i]
+                self._log("remove", album=i)
                 break
 
         if stop:
             play = self.is_playing()
             self.stop()
             self.track_idx = 0
+            self._log("track", index=self.track_idx)
             if play:
                 self.playpause()
 
-        self.save()
         util.EventBus.send(util.Listener.playlist_changed)
 
 
@@ -348,25 +565,24 @@ class UIAdapter:
             self._playlist_released_key(event)
 
     def _skip_selection(self, skip):
-        for item in self.ui.playlistUI.selectedItems():
-            widget = self.ui.playlistUI.itemWidget(item)
-            if isinstance(widget, AlbumUI):
-                if skip:
-                    app.get().playlist.remove_album(widget.album)
-            else:
-                widget.track.skip = skip
-                widget.update()
+        # The list is rebuilt on playlist changes, so hold them until the end.
+        with util.EventBus.batch():
+            for item in self.ui.playlistUI.selectedItems():
+                widget = self.ui.playlistUI.itemWidget(item)
+                if isinstance(widget, AlbumUI):
+                    if skip:
+                        app.get().playlist.remove_album(widget.album)
+                else:
+                    app.get().playlist.set_skip(widget.track, skip)
+                    widget.update()
 
     def _toggle_kill_track(self):
+        tracks = []
         for item in self.ui.playlistUI.selectedItems():
             widget = self.ui.playlistUI.itemWidget(item)
-            if not isinstance(widget, TrackUI):
-                continue
-
-            widget.track.info.skip = not widget.track.info.skip
-            widget.update()
-
-        app.get().collection.save()
+            if isinstance(widget, TrackUI):
+                tracks.append(widget.track)
+        app.get().playlist.toggle_kill(tracks)
 
     def _set_stop_after(self):
         items = self.ui.playlistUI.selectedItems()
@@ -0,0 +1,90 @@
+# SPDX-License-Identifier: BSD-2-Clause
+import collections
+import os
+import threading
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class Prefetcher:
+    """
+    Warms the page cache from a background thread with files that are about to be
+    played; a new request replaces any pending one.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.bytes = 0
+        self.files = 0
+        self._warm = collections.OrderedDict()
+        self._pending = None
+        self._cond = threading.Condition()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="prefetch", daemon=True)
+        self._thread.start()
+
+    def request(self, paths):
+        with self._cond:
+            self._pending = list(paths)
+            self._cond.notify()
+
+    def is_warm(self, path):
+        with self._cond:
+            return path in self._warm
+
+    def shutdown(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join(1)
+
+    def report(self):
+        print(f"prefetch: {self.files} files, {self.bytes // (1024 * 1024)} MiB read")
+
+    def _run(self):
+        buf = bytearray(CHUNK_SIZE)
+        while True:
+            with self._cond:
+                while self._running and self._pending is None:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                paths = self._pending
+                self._pending = None
+
+            budget = self.budget
+            for path in paths:
+                if budget <= 0 or self._pending is not None:
+                    break
+                if self.is_warm(path):
+                    continue
+
+                try:
+                    read = self._read(path, budget, buf)
+                except OSError as e:
+                    print(f"prefetch: error reading {path}: {e}")
+                    continue
+
+                budget -= read
+                with self._cond:
+                    self.bytes += read
+                    self.files += 1
+                    self._warm[path] = read
+                    while len(self._warm) > 32:
+                        self._warm.popitem(last=False)
+
+    def _read(self, path, limit, buf):
+        with open(path, "rb", buffering=0) as f:
+            size = min(os.fstat(f.fileno()).st_size, limit)
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(f.fileno(), 0, size, os.POSIX_FADV_WILLNEED)
+
+            # Also read the data, since read-ahead hints are not guaranteed to be
+            # acted upon, especially on network file systems.
+            read = 0
+            while read < size and self._pending is None:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                read += n
+            return read
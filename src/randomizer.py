@@ -1,4 +1,7 @@
 # SPDX-License-Identifier: BSD-2-Clause
+import collections
+import math
+import os
 import random
 import time
 
@@ -6,13 +9,172 @@ import app
 import util
 
 
+class FenwickTree:
+    """
+    Binary indexed tree of weights, supporting prefix sums, weight updates and
+    lookups by cumulative weight in O(log n).
+    """
+
+    def __init__(self, weights):
+        self._size = len(weights)
+        self._tree = [0.0] + list(weights)
+        for i in range(1, self._size + 1):
+            parent = i + (i & -i)
+            if parent <= self._size:
+                self._tree[parent] += self._tree[i]
+        self._weights = list(weights)
+
+    def total(self):
+        return self.prefix(self._size)
+
+    def prefix(self, end):
+        """
+        Returns the sum of the weights in [0, end).
+        """
+        total = 0.0
+        while end > 0:
+            total += self._tree[end]
+            end -= end & -end
+        return total
+
+    def set(self, idx, weight):
+        delta = weight - self._weights[idx]
+        self._weights[idx] = weight
+        idx += 1
+        while idx <= self._size:
+            self._tree[idx] += delta
+            idx += idx & -idx
+
+    def find(self, target):
+        """
+        Returns the index of the item in which the cumulative weight `target` falls.
+        """
+        idx = 0
+        step = 1 << self._size.bit_length()
+        while step:
+            nxt = idx + step
+            if nxt <= self._size and self._tree[nxt] <= target:
+                idx = nxt
+                target -= self._tree[nxt]
+            step >>= 1
+        return min(idx, self._size - 1)
+
+
+class AlbumIndex:
+    """
+    Albums laid out contiguously by artist, so that a random, optionally weighted, pick
+    that excludes some artists costs time proportional to the number excluded.
+    """
+
+    def __init__(self, albums, weight=None):
+        by_artist = collections.defaultdict(list)
+        for a in albums:
+            by_artist[a.artist].append(a)
+
+        self.albums = []
+        self.ranges = {}
+        for artist, lst in by_artist.items():
+            self.ranges[artist] = (len(self.albums), len(self.albums) + len(lst))
+            self.albums.extend(lst)
+
+        self.created = time.time()
+        self.weights = None
+        if weight:
+            self._positions = {id(a): i for i, a in enumerate(self.albums)}
+            self.weights = FenwickTree([weight(a) for a in self.albums])
+
+    def set_weight(self, album, weight):
+        idx = self._positions.get(id(album))
+        if idx is not None:
+            self.weights.set(idx, weight)
+
+    def pick(self, rnd, exclude):
+        """
+        Returns a random album by an artist not in `exclude`, or None if there is no
+        such album.
+        """
+        holes = sorted(self.ranges[a] for a in set(exclude) if a in self.ranges)
+        if self.weights:
+            return self._pick_weighted(rnd, holes)
+
+        eligible = len(self.albums) - sum(end - start for start, end in holes)
+        if eligible <= 0:
+            return None
+
+        # Pick among eligible albums, then skip over the excluded ranges that come
+        # before the pick.
+        idx = rnd.randrange(eligible)
+        for start, end in holes:
+            if idx < start:
+                break
+            idx += end - start
+        return self.albums[idx]
+
+    def _pick_weighted(self, rnd, holes):
+        # Same as the uniform case, with positions measured in cumulative weight.
+        tree = self.weights
+        holes = [(tree.prefix(start), tree.prefix(end)) for start, end in holes]
+        eligible = tree.total() - sum(end - start for start, end in holes)
+        if eligible <= 0:
+            return None
+
+        target = rnd.random() * eligible
+        for start, end in holes:
+            if target < start:
+                break
+            target += end - start
+        return self.albums[tree.find(target)]
+
+
 class Randomizer(util.ConfigObj, util.Listener):
-    def __init__(self):
+    # Weight of an album that was just played, relative to one that has not been
+    # played in RECOVERY_DAYS or more.
+    MIN_WEIGHT = 0.01
+    RECOVERY_DAYS = 180
+
+    def __init__(self, seed=None):
         self.history = []
-        self._rnd = random.Random(time.time())
+        self._rnd = random.Random(time.time() if seed is None else seed)
         self._now_playing = None
+        self._index = None
+        self._indexed = None
+        self._stats = None
         util.EventBus.add(self)
 
+    @classmethod
+    def weight(cls, last_played, plays, now):
+        """
+        Returns the weight of an album last played at `last_played` (None if never),
+        and played `plays` times, for weighted picks.
+        """
+        if last_played is None:
+            return 1.0
+
+        days = (now - last_played) / 86400
+        recency = max(cls.MIN_WEIGHT, min(days / cls.RECOVERY_DAYS, 1.0))
+        return recency / (1 + math.log1p(plays))
+
+    def track_ended(self, track):
+        path = os.path.dirname(track.path)
+        self.album_played(app.get().collection.get_album(path), time.time())
+
+    def album_played(self, album, now):
+        # The play itself is recorded by the history, which the weights are built
+        # from; only the index needs to catch up.
+        if album and self._index and self._index.weights:
+            self._index.set_weight(album, self.weight(now, self._plays(album), now))
+
+    def _play_stats(self):
+        return self._stats or app.get().history
+
+    def _plays(self, album):
+        # The history counts track plays; weights count whole albums.
+        return self._play_stats().plays(album.path) / max(len(album.tracks), 1)
+
+    def _album_weight(self, album, now):
+        last = self._play_stats().last_played(album.path)
+        return self.weight(last, self._plays(album), now)
+
     def track_playing(self, track):
         new_artist = track.artist
         if self._now_playing and new_artist != self._now_playing:
@@ -32,17 +194,43 @@ class Randomizer(util.ConfigObj, util.Listener):
             print("No albums.")
             return
 
-        ignore = self.history + [x.info.artist for x in app.get().playlist.albums]
-        while True:
-            next = self._rnd.choice(app.get().collection.albums)
-            if next.artist in ignore:
-                continue
+        queued = [x.info.artist for x in app.get().playlist.albums]
+        next = self.choose(app.get().collection.albums, queued, app.get().weighted)
+        app.get().playlist.replace(next, play=play)
 
-            app.get().playlist.replace(next, play=play)
-            return
+    def choose(self, albums, queued, weighted=False):
+        """
+        Picks an album by an artist in neither the history nor `queued`, dropping those
+        conditions in that order if needed; weighted by play history if `weighted`.
+        """
+        if (
+            self._indexed is not albums
+            or bool(self._index.weights) != weighted
+            or (weighted and time.time() - self._index.created > 86400)
+        ):
+            # Weights also depend on time since an album was last played, so they
+            # are recomputed once a day.
+            weight = None
+            if weighted:
+                now = time.time()
+                weight = lambda a: self._album_weight(a, now)
+            self._index = AlbumIndex(albums, weight=weight)
+            self._indexed = albums
 
-    def _add_to_history(self, artist):
+        return (
+            self._index.pick(self._rnd, self.history + queued)
+            or self._index.pick(self._rnd, queued)
+            or self._index.pick(self._rnd, [])
+        )
+
+    def remember(self, artist, bias):
+        """
+        Adds an artist to the history, which keeps the last `bias` artists played.
+        """
         self.history.append(artist)
-        if len(self.history) > app.get().bias:
+        if len(self.history) > bias:
             del self.history[0]
+
+    def _add_to_history(self, artist):
+        self.remember(artist, app.get().bias)
         self.save()
@@ -1,14 +1,122 @@
 # SPDX-License-Identifier: BSD-2-Clause
-import dbus
-import dbus.service
+#
+# Client side of the remote control interfaces. This is imported by `folderme
+# --remote`, so it should not import anything heavy (e.g. Qt or D-Bus) up front.
+import json
+import os
+import socket
+import sys
+import tempfile
 
 DBUS_SERVICE = "org.vanzin.FolderME"
 DBUS_OBJECT = "/org/vanzin/FolderME"
 REMOTE_CONTROL_IFACE = f"{DBUS_SERVICE}.Remote"
 
+SOCKET_NAME = "folderme.sock"
+
+# Commands available through the D-Bus remote control interface.
+DBUS_COMMANDS = {
+    "next",
+    "osd",
+    "playpause",
+    "prev",
+    "quit",
+    "stats",
+    "stop",
+    "stop_after_track",
+}
+
+
+class NotListening(Exception):
+    pass
+
+
+def control_socket():
+    runtime = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime:
+        return os.path.join(runtime, SOCKET_NAME)
+    return os.path.join(tempfile.gettempdir(), f"folderme-{os.getuid()}.sock")
+
+
+def parse(cmd):
+    """
+    Parses a command line argument of the form "name" or "name=arg" (for commands
+    that take one argument) into a control command.
+    """
+    name, _, arg = cmd.partition("=")
+    command = {"cmd": name}
+    if name == "enqueue":
+        command["path"] = os.path.abspath(arg)
+    elif arg:
+        raise ValueError(f"Command {name} does not take arguments.")
+    return command
+
+
+def request(commands, timeout=10):
+    """
+    Sends a batch of commands over the control socket, returning their results, or
+    raises NotListening, having sent nothing, if the player is not there.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.settimeout(timeout)
+        try:
+            s.connect(control_socket())
+        except (FileNotFoundError, ConnectionRefusedError) as e:
+            raise NotListening(str(e)) from e
+        s.sendall(json.dumps(commands).encode("utf-8") + b"\n")
+        with s.makefile("rb") as f:
+            line = f.readline()
+    if not line:
+        raise ConnectionError("Connection closed by player.")
+    return json.loads(line)
+
+
+def send(cmds):
+    """
+    Sends commands to the player over the control socket, or D-Bus if it is not
+    listening, returning whether they all succeeded.
+    """
+    try:
+        commands = [parse(c) for c in cmds]
+    except ValueError as e:
+        print(f"error: {e} Usage: --remote CMD or --remote CMD=ARG", file=sys.stderr)
+        return False
+
+    try:
+        results = request(commands)
+    except NotListening:
+        return _send_dbus(commands)
+    except OSError as e:
+        # The player may have run some of the commands, so do not retry them.
+        print(f"error talking to player: {e}", file=sys.stderr)
+        return False
+
+    if not isinstance(results, list):
+        # The whole batch failed.
+        print(f"error: {results.get('error')}", file=sys.stderr)
+        return False
+
+    ok = True
+    for command, result in zip(commands, results):
+        if not result["ok"]:
+            print(f"{command['cmd']}: {result['error']}", file=sys.stderr)
+            ok = False
+        elif isinstance(result["result"], str):
+            print(result["result"], end="")
+        elif result["result"] is not None:
+            print(json.dumps(result["result"], indent=2))
+    return ok
+
+
+def _send_dbus(commands):
+    import dbus
 
-def send(cmd):
     bus = dbus.SessionBus()
     server = bus.get_object(DBUS_SERVICE, DBUS_OBJECT)
-    method = getattr(server, cmd)
-    method(dbus_interface=REMOTE_CONTROL_IFACE)
+    for command in commands:
+        if len(command) > 1 or command["cmd"] not in DBUS_COMMANDS:
+            print(f"{command['cmd']}: not available over D-Bus", file=sys.stderr)
+            return False
+        method = getattr(server, command["cmd"])
+        method(dbus_interface=REMOTE_CONTROL_IFACE)
+    return True
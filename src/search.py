@@ -0,0 +1,336 @@
+# SPDX-License-Identifier: BSD-2-Clause
+import bisect
+import collections
+import heapq
+import sys
+import threading
+import unicodedata
+
+import app
+import util
+
+ALBUM = 0
+TRACK = 1
+
+# How much a match on each field counts towards a result's score.
+ARTIST_WEIGHT = 3
+TITLE_WEIGHT = 2
+TRACK_WEIGHT = 1
+
+# Trigrams that appear in more documents than this are too common to be useful as
+# search candidates (e.g. "the"), unless they are all the query has.
+MAX_TRIGRAM_DOCS = 5000
+MIN_TRIGRAM_SCORE = 0.5
+
+# Query words shorter than this only match whole words, since a single letter would
+# otherwise be a prefix of a large part of the index.
+MIN_PREFIX = 2
+
+# Candidate count under which further query words are matched by scanning the
+# candidates instead of the index.
+FILTER_THRESHOLD = 2000
+
+# Sorts after any character that can follow a prefix in a token.
+_LAST_CHAR = chr(sys.maxunicode)
+
+_INDEX = None
+_BUILDING = None
+_WAITING = []
+_QUEUE = None
+
+
+def index():
+    """
+    Returns the search index for the collection, or None if it has not been built
+    yet; see `build()`.
+    """
+    return _INDEX
+
+
+def build(done=None):
+    """
+    Starts building the search index on a background thread, unless it is already
+    built or being built. `done` is called on the GUI thread once it is ready, or
+    building it failed.
+    """
+    global _BUILDING, _QUEUE
+    if _INDEX:
+        if done:
+            done()
+        return
+
+    if done and done not in _WAITING:
+        _WAITING.append(done)
+    if _BUILDING is not None:
+        return
+
+    if not _QUEUE:
+        _QUEUE = util.GuiQueue()
+    _BUILDING = app.get().collection.albums
+    threading.Thread(
+        target=_build, args=(_BUILDING,), name="search index", daemon=True
+    ).start()
+
+
+def _build(albums):
+    idx = None
+    try:
+        with util.profile("search index"):
+            idx = SearchIndex(albums)
+    except Exception:
+        print("Error building search index.")
+        util.print_error()
+    _QUEUE.call(_built, albums, idx)
+
+
+def _built(albums, idx):
+    global _BUILDING, _INDEX
+    _BUILDING = None
+    if idx and albums is not app.get().collection.albums:
+        # The collection was rescanned meanwhile, and the index missed the update.
+        build()
+        return
+
+    if idx:
+        _INDEX = idx
+        util.EventBus.add(_INDEX)
+    waiting = list(_WAITING)
+    _WAITING.clear()
+    for done in waiting:
+        done()
+
+
+_ASCII_TABLE = str.maketrans({chr(c): " " for c in range(128) if not chr(c).isalnum()})
+
+
+def normalize(text):
+    text = str(text)
+    if text.isascii():
+        return text.lower().translate(_ASCII_TABLE)
+
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c)).casefold()
+    return "".join(c if c.isalnum() else " " for c in text)
+
+
+def _trigrams(text):
+    text = f" {' '.join(text.split())} "
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+class Result:
+    def __init__(self, kind, album, track, score):
+        self.kind = kind
+        self.album = album
+        self.track = track
+        self.score = score
+
+    def __str__(self):
+        if self.kind == ALBUM:
+            return f"{self.album.artist} - {self.album.title}"
+        return f"{self.track.title} ({self.album.artist} - {self.album.title})"
+
+
+class SearchIndex(util.Listener):
+    """
+    In-memory index over artist names, album titles and track titles, matching query
+    words as prefixes, with a trigram fallback for approximate matches.
+    """
+
+    def __init__(self, albums=()):
+        self._docs = {}
+        self._next_id = 0
+        self._album_docs = {}
+        self._tokens = []
+        self._postings = {}
+        self._trigrams = collections.defaultdict(set)
+
+        # Sort the token list once at the end of the initial build, instead of
+        # inserting each new token in place.
+        self._bulk = True
+        for a in albums:
+            self.add_album(a)
+        self._tokens.sort()
+        self._bulk = False
+
+    def collection_updated(self, added, removed):
+        for a in removed:
+            self.remove_album(a)
+        for a in added:
+            self.add_album(a)
+
+    def add_album(self, album):
+        ids = [
+            self._add_doc(
+                (ALBUM, album, None),
+                [(album.artist, ARTIST_WEIGHT), (album.title, TITLE_WEIGHT)],
+            )
+        ]
+        for t in album.tracks:
+            ids.append(self._add_doc((TRACK, album, t), [(t.title, TRACK_WEIGHT)]))
+        self._album_docs[id(album)] = ids
+
+    def remove_album(self, album):
+        for doc_id in self._album_docs.pop(id(album), []):
+            doc, tokens, trigrams = self._docs.pop(doc_id)
+            for token, weight in tokens.items():
+                groups = self._postings[token]
+                docs = groups[(doc[0], weight)]
+                docs.pop(doc_id, None)
+                if not docs:
+                    del groups[(doc[0], weight)]
+                if not groups:
+                    del self._postings[token]
+                    del self._tokens[bisect.bisect_left(self._tokens, token)]
+            for tri in trigrams:
+                docs = self._trigrams[tri]
+                docs.discard(doc_id)
+                if not docs:
+                    del self._trigrams[tri]
+
+    def search(self, query, limit=50):
+        words = normalize(query).split()
+        if not words:
+            return []
+
+        if len(set(words)) == 1:
+            scores = self._top_matches(words[0], limit)
+        else:
+            scores = self._prefix_search(words)
+        if len(scores) < limit:
+            for doc_id, score in self._trigram_search(" ".join(words)).items():
+                if doc_id not in scores:
+                    scores[doc_id] = score
+
+        best = heapq.nsmallest(
+            limit, scores.items(), key=lambda x: (-x[1], self._docs[x[0]][0][0], x[0])
+        )
+        return [Result(*self._docs[doc_id][0], score) for doc_id, score in best]
+
+    def _add_doc(self, doc, fields):
+        doc_id = self._next_id
+        self._next_id += 1
+
+        tokens = {}
+        text = []
+        for value, weight in fields:
+            value = normalize(value or "")
+            text.append(value)
+            for token in value.split():
+                tokens[token] = max(tokens.get(token, 0), weight)
+
+        for token, weight in tokens.items():
+            groups = self._postings.get(token)
+            if groups is None:
+                groups = self._postings[token] = {}
+                if self._bulk:
+                    self._tokens.append(token)
+                else:
+                    bisect.insort(self._tokens, token)
+            groups.setdefault((doc[0], weight), {})[doc_id] = None
+
+        trigrams = set()
+        for value in text:
+            trigrams |= _trigrams(value)
+        for tri in trigrams:
+            self._trigrams[tri].add(doc_id)
+
+        self._docs[doc_id] = (doc, tokens, trigrams)
+        return doc_id
+
+    def _matching_tokens(self, prefix):
+        if len(prefix) < MIN_PREFIX:
+            return [prefix] if prefix in self._postings else []
+
+        start = bisect.bisect_left(self._tokens, prefix)
+        end = bisect.bisect_left(self._tokens, prefix + _LAST_CHAR, start)
+        return self._tokens[start:end]
+
+    def _groups(self, prefix):
+        """
+        Yields (score, kind, doc ids) for the posting lists matching `prefix`.
+        """
+        for token in self._matching_tokens(prefix):
+            # Exact word matches rank above prefix matches.
+            bonus = 1 if token == prefix else 0
+            for (kind, weight), docs in self._postings[token].items():
+                yield weight + bonus, kind, docs
+
+    def _prefix_matches(self, prefix):
+        matches = {}
+        for score, _, docs in self._groups(prefix):
+            for doc_id in docs:
+                if matches.get(doc_id, 0) < score:
+                    matches[doc_id] = score
+        return matches
+
+    def _prefix_size(self, prefix):
+        return sum(len(docs) for _, _, docs in self._groups(prefix))
+
+    def _top_matches(self, prefix, limit):
+        """
+        Returns the best `limit` matches for a single word, without scoring every
+        matching document.
+        """
+        # Results are ranked by score, then kind, then id. Posting lists are in id
+        # order, so merging those of each (score, kind) in rank order yields the
+        # results in order, and a document seen again has a lower score.
+        ranked = collections.defaultdict(list)
+        for score, kind, docs in self._groups(prefix):
+            ranked[(-score, kind)].append(docs)
+
+        matches = {}
+        for key in sorted(ranked):
+            for doc_id in heapq.merge(*ranked[key]):
+                if doc_id not in matches:
+                    matches[doc_id] = -key[0]
+                    if len(matches) >= limit:
+                        return matches
+        return matches
+
+    def _prefix_search(self, words):
+        # Start with the most selective word, and only keep documents that match all
+        # words. Remaining words are checked against the candidates' own tokens,
+        # which is cheaper than looking them up in the index once the candidate list
+        # is small.
+        words = sorted(set(words), key=self._prefix_size)
+        scores = self._prefix_matches(words[0])
+        for word in words[1:]:
+            if not scores:
+                break
+
+            if len(scores) > FILTER_THRESHOLD:
+                matches = self._prefix_matches(word)
+                scores = {d: s + matches[d] for d, s in scores.items() if d in matches}
+                continue
+
+            filtered = {}
+            for doc_id, score in scores.items():
+                best = 0
+                for token, weight in self._docs[doc_id][1].items():
+                    if token == word:
+                        best = max(best, weight + 1)
+                    elif len(word) >= MIN_PREFIX and token.startswith(word):
+                        best = max(best, weight)
+                if best:
+                    filtered[doc_id] = score + best
+            scores = filtered
+        return scores
+
+    def _trigram_search(self, text):
+        query = _trigrams(text)
+        postings = [self._trigrams[t] for t in query if t in self._trigrams]
+        selective = [p for p in postings if len(p) <= MAX_TRIGRAM_DOCS]
+        if selective:
+            postings = selective
+
+        counts = collections.Counter()
+        for docs in postings:
+            counts.update(docs)
+
+        scores = {}
+        for doc_id, count in counts.items():
+            score = count / len(query)
+            if score >= MIN_TRIGRAM_SCORE:
+                scores[doc_id] = score
+        return scores
@@ -1,17 +1,29 @@
 # SPDX-License-Identifier: BSD-2-Clause
+import collections
+import concurrent.futures
+import functools
+import hashlib
+import importlib.util
+import json
+import math
 import os
+import re
+import shutil
+import subprocess
+import threading
 import time
 import traceback
 from contextlib import contextmanager
 
 import jsonpickle
+from PySide6 import QtWidgets
+from PySide6.QtCore import QObject
 from PySide6.QtCore import QSettings
-from PySide6.QtCore import QTimer
 from PySide6.QtCore import Qt
+from PySide6.QtCore import Signal
 from PySide6.QtGui import QFontMetrics
 from PySide6.QtGui import QPixmap
 from PySide6.QtGui import QPixmapCache
-from PySide6.QtUiTools import loadUiType
 
 SETTINGS = QSettings("vanzin.org", "folderme")
 
@@ -48,46 +60,352 @@ class ConfigObj:
             jsonpickle.set_encoder_options("json", indent=2)
             path = os.path.join(config_dir(create=True), self.config_file_name())
             data = jsonpickle.encode(self)
-            with open(path, "wt", encoding="utf-8") as out:
-                out.write(data)
+            atomic_write(path, data)
+
+
+class Journal:
+    """
+    An append-only log of JSON records that complements a `ConfigObj` snapshot.
+    """
+
+    def __init__(self, name):
+        self.path = os.path.join(config_dir(), f"{name}.journal")
+        self.count = 0
+        self._out = None
+
+    def append(self, op, **args):
+        if not ConfigObj.SAVE_ENABLED:
+            return
+
+        if not self._out:
+            config_dir(create=True)
+            self._out = open(self.path, "at", encoding="utf-8")
+
+        args["op"] = op
+        self._out.write(json.dumps(args) + "\n")
+        self._out.flush()
+        if hasattr(os, "fdatasync"):
+            os.fdatasync(self._out.fileno())
+        else:
+            os.fsync(self._out.fileno())
+        self.count += 1
+
+    def replay(self):
+        if not os.path.isfile(self.path):
+            return
+
+        with open(self.path, "r+b") as f:
+            valid = 0
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                valid += len(line)
+                self.count += 1
+                yield record
+
+            # Drop any torn record so that new entries are not appended after it.
+            f.truncate(valid)
+
+    def reset(self):
+        if self._out:
+            self._out.close()
+            self._out = None
+        if os.path.isfile(self.path):
+            os.unlink(self.path)
+        self.count = 0
+
+    def rewrite(self, records):
+        """
+        Atomically replaces the contents of the journal with the given `(op, args)`
+        records.
+        """
+        if not ConfigObj.SAVE_ENABLED:
+            return
+
+        if self._out:
+            self._out.close()
+            self._out = None
+        config_dir(create=True)
+        atomic_write(
+            self.path, "".join(json.dumps({**a, "op": op}) + "\n" for op, a in records)
+        )
+        self.count = len(records)
 
 
 class EventBus:
     """
-    An event bus for `Listener` events.
+    An event bus for `Listener` events, which only calls the listeners that handle
+    each event.
     """
 
     FIRING = False
-    QUEUE = []
+    QUEUE = collections.deque()
     LISTENERS = []
+    WORKERS = {}
+    STATS = None
+    COALESCE = {"collection_changed", "playlist_changed", "track_position_changed"}
+    HANDLERS = {}
 
     @classmethod
     def add(cls, l):
         cls.LISTENERS.append(l)
+        if getattr(l, "ASYNC", False):
+            cls.WORKERS[id(l)] = ListenerWorker(l)
+        cls._update_handlers()
+
+    @classmethod
+    def remove(cls, l):
+        if l in cls.LISTENERS:
+            cls.LISTENERS.remove(l)
+            cls._update_handlers()
+            worker = cls.WORKERS.pop(id(l), None)
+            if worker:
+                worker.stop()
+
+    @classmethod
+    def shutdown(cls, timeout=2):
+        """
+        Delivers events still queued for asynchronous listeners, waiting at most
+        `timeout` seconds for each of them.
+        """
+        for w in cls.WORKERS.values():
+            w.stop(timeout)
+        cls.WORKERS = {}
+
+    @classmethod
+    def _handler(cls, l, name):
+        worker = cls.WORKERS.get(id(l))
+        if worker:
+            return lambda *args: worker.post(name, args)
+        return getattr(l, name)
+
+    @classmethod
+    def _update_handlers(cls):
+        # Tables are rebuilt instead of modified in place, so that listeners can be
+        # added or removed while an event is being dispatched.
+        handlers = {}
+        for name in Listener.EVENTS:
+            default = getattr(Listener, name)
+            handlers[name] = tuple(
+                (type(l).__name__, cls._handler(l, name))
+                for l in cls.LISTENERS
+                if getattr(type(l), name, default) is not default
+            )
+        cls.HANDLERS = handlers
 
     @classmethod
     def send(cls, handler, *args):
+        """
+        Delivers an event to all listeners. Events sent by listeners while another
+        event is being delivered are queued, and delivered in order once the current
+        event has reached all listeners. For events in `COALESCE`, only the latest
+        pending instance is delivered.
+        """
+        name = handler.__name__
+        if name in cls.COALESCE and cls.QUEUE:
+            cls.QUEUE = collections.deque(e for e in cls.QUEUE if e[0] != name)
+        cls.QUEUE.append((name, args))
+
+        if not cls.FIRING:
+            cls._deliver()
+
+    @classmethod
+    @contextmanager
+    def batch(cls):
+        """
+        Holds events sent within the block, and delivers them in order at its end.
+        """
         if cls.FIRING:
-            QTimer.singleShot(0, lambda: cls.send(handler, *args))
+            yield
             return
 
         cls.FIRING = True
+        try:
+            yield
+        finally:
+            cls._deliver()
 
-        for l in cls.LISTENERS:
-            m = getattr(l, handler.__name__, None)
-            if m:
-                try:
-                    m(*args)
-                except:
-                    traceback.print_exc()
+    @classmethod
+    def _deliver(cls):
+        cls.FIRING = True
+        try:
+            while cls.QUEUE:
+                name, args = cls.QUEUE.popleft()
+                stats = cls.STATS
+                for label, m in cls.HANDLERS.get(name, ()):
+                    start = time.perf_counter() if stats else 0
+                    try:
+                        m(*args)
+                    except:
+                        traceback.print_exc()
+                    if stats:
+                        stats.record(name, label, time.perf_counter() - start)
+        finally:
+            cls.FIRING = False
+
+
+class PlayedTime:
+    """
+    How much of a track was played, from position updates; jumps of more than
+    `MAX_STEP_MS`, or backwards, are seeks and do not count.
+    """
+
+    MAX_STEP_MS = 2500
+
+    def __init__(self):
+        self.ms = 0
+        self._position = 0
+
+    def reset(self):
+        self.ms = 0
+        self._position = 0
+
+    def update(self, position):
+        delta = position - self._position
+        if 0 < delta <= self.MAX_STEP_MS:
+            self.ms += delta
+        self._position = position
+
+
+class Histogram:
+    """
+    A latency histogram with logarithmic buckets, each about 19% wider than the
+    previous one.
+    """
+
+    STEPS = 4
+
+    def __init__(self):
+        self.count = 0
+        self.max = 0
+        self._buckets = collections.Counter()
+
+    def add(self, ms):
+        self.count += 1
+        self.max = max(self.max, ms)
+        bucket = math.ceil(math.log2(ms) * self.STEPS) if ms > 0.001 else -40
+        self._buckets[bucket] += 1
+
+    def percentile(self, p):
+        """
+        Returns an upper bound for the given percentile (0-100).
+        """
+        target = self.count * p / 100
+        seen = 0
+        for bucket in sorted(self._buckets):
+            seen += self._buckets[bucket]
+            if seen >= target:
+                return min(2 ** (bucket / self.STEPS), self.max)
+        return self.max
+
+    def __str__(self):
+        return (
+            f"n={self.count} p50={self.percentile(50):.2f}ms "
+            f"p99={self.percentile(99):.2f}ms max={self.max:.2f}ms"
+        )
+
+
+class EventStats:
+    """
+    Per event and listener call counts and latencies, for finding listeners that
+    slow down event delivery. Calls on the sending thread that take longer than
+    `budget_ms` are logged as they happen.
+    """
+
+    def __init__(self, budget_ms):
+        self.budget_ms = budget_ms
+        self._lock = threading.Lock()
+        self._latencies = collections.defaultdict(Histogram)
+
+    def record(self, event, listener, secs, budget=True):
+        ms = secs * 1000
+        with self._lock:
+            self._latencies[(event, listener)].add(ms)
+        if budget and ms > self.budget_ms:
+            print(f"slow handler: {listener}.{event} took {ms:.1f} ms")
+
+    def dump(self):
+        with self._lock:
+            entries = sorted(self._latencies.items())
+        print("event stats:")
+        for (event, listener), hist in entries:
+            print(f"  {event:24} {listener:24} {hist}")
 
-        cls.FIRING = False
+
+class ListenerWorker:
+    """
+    Calls an asynchronous listener's handlers from a dedicated thread, through a
+    bounded queue of pending events.
+    """
+
+    def __init__(self, listener):
+        self.listener = listener
+        self.depth = listener.ASYNC_QUEUE_DEPTH
+        self.dropped = 0
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._run, name=type(listener).__name__, daemon=True
+        )
+        self._thread.start()
+
+    def post(self, name, args):
+        with self._cond:
+            if name in EventBus.COALESCE and self._queue:
+                self._queue = collections.deque(e for e in self._queue if e[0] != name)
+            if len(self._queue) >= self.depth:
+                dropped = self._queue.popleft()
+                self.dropped += 1
+                print(f"{self._thread.name}: queue full, dropping {dropped[0]}")
+            self._queue.append((name, args))
+            self._cond.notify()
+
+    def stop(self, timeout=None):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and not self._queue:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                name, args = self._queue.popleft()
+
+            stats = EventBus.STATS
+            start = time.perf_counter() if stats else 0
+            try:
+                getattr(self.listener, name)(*args)
+            except:
+                traceback.print_exc()
+            if stats:
+                label = f"{self._thread.name} (async)"
+                stats.record(name, label, time.perf_counter() - start, budget=False)
 
 
 class Listener:
+    """
+    Base class for event listeners. Listeners that set `ASYNC` are called from a
+    worker thread of their own, and must not touch the UI.
+    """
+
+    ASYNC = False
+    ASYNC_QUEUE_DEPTH = 64
+
     def collection_changed(self):
         pass
 
+    def collection_updated(self, added, removed):
+        pass
+
     def playlist_changed(self):
         pass
 
@@ -103,6 +421,9 @@ class Listener:
     def track_position_changed(self, track, position):
         pass
 
+    def track_seeked(self, track, position):
+        pass
+
     def track_stopped(self, track):
         pass
 
@@ -119,22 +440,94 @@ class Listener:
         pass
 
 
+Listener.EVENTS = [
+    n for n, v in vars(Listener).items() if callable(v) and not n.startswith("_")
+]
+
+
+class GuiQueue(QObject):
+    """
+    Runs callables on the GUI thread, in the order they are queued from other
+    threads.
+    """
+
+    queued = Signal(object)
+
+    def __init__(self):
+        QObject.__init__(self)
+        self.queued.connect(self._run)
+
+    def call(self, fn, *args):
+        """
+        Queues a call, without waiting for it to run.
+        """
+        self.queued.emit(functools.partial(fn, *args))
+
+    def run(self, fn, *args, timeout=None):
+        """
+        Queues a call and waits for its result; exceptions are re-raised in the
+        calling thread.
+        """
+        future = concurrent.futures.Future()
+
+        def call():
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+        self.queued.emit(call)
+        return future.result(timeout)
+
+    def _run(self, fn):
+        try:
+            fn()
+        except Exception:
+            print_error()
+
+
+class GuiProxy:
+    """
+    Forwards method calls to `target` through a `GuiQueue`, so that code running on
+    other threads (e.g. D-Bus handlers) can use it.
+    """
+
+    def __init__(self, target):
+        self._target = target
+        self._queue = GuiQueue()
+
+    def __getattr__(self, name):
+        method = getattr(self._target, name)
+        return lambda *args: self._queue.call(method, *args)
+
+
 class PixmapCache:
     def __init__(self):
         self._cache = QPixmapCache()
         self._cache.setCacheLimit(64 * 1024 * 1024)
 
     def get_cover(self, album):
-        track = album.tracks[0]
-        pixmap = self._cache.find(os.path.dirname(track.info.path))
+        return self.get_track_cover(album.tracks[0].info)
+
+    def get_track_cover(self, track, size=None):
+        key = os.path.dirname(track.path)
+        if size:
+            key = f"{key}@{size}"
+
+        pixmap = self._cache.find(key)
         if not pixmap:
-            pixmap = QPixmap()
-            cover = track.info.cover_art()
-            if cover:
-                pixmap.loadFromData(cover)
+            if size:
+                pixmap = self.get_track_cover(track).scaled(
+                    size, size, Qt.KeepAspectRatio, Qt.SmoothTransformation
+                )
             else:
-                pixmap.load(icon("blank.jpg"))
-            self._cache.insert(track.info.path, pixmap)
+                pixmap = QPixmap()
+                cover = track.cover_art()
+                if cover:
+                    pixmap.loadFromData(cover)
+                else:
+                    pixmap.load(icon("blank.jpg"))
+            self._cache.insert(key, pixmap)
         return pixmap
 
     def remove_cover(self, album):
@@ -177,9 +570,26 @@ class ElisionHelper:
             self.label.setToolTip(None)
 
 
+# Forms are compiled to Python modules named after the hash of their source. The
+# package ships them in UI_COMPILED_DIR (see DEBIAN/mkdeb.sh); otherwise they are
+# generated on first use into the user's cache directory.
+UI_DIR = os.path.join(os.path.dirname(__file__), "ui")
+UI_COMPILED_DIR = os.path.join(UI_DIR, "compiled")
+UI_PRECOMPILED = True
+
+_UI_ROOT_RE = re.compile(r'<widget class="(\w+)"')
+_UI_FORM_RE = re.compile(r"^class (Ui_\w+)\(object\):", re.MULTILINE)
+
+
 def compile_ui(src):
-    path = os.path.join(os.path.dirname(__file__), "ui", src)
-    form, qtclass = loadUiType(path)
+    path = os.path.join(UI_DIR, src)
+    compiled = _load_compiled_ui(path) if UI_PRECOMPILED else None
+    if compiled:
+        form, qtclass = compiled
+    else:
+        from PySide6.QtUiTools import loadUiType
+
+        form, qtclass = loadUiType(path)
 
     class _WidgetBase(form, qtclass):
         def __init__(self, parent=None):
@@ -190,6 +600,83 @@ def compile_ui(src):
     return _WidgetBase
 
 
+def precompile_ui(out_dir=UI_COMPILED_DIR):
+    """
+    Compiles all forms into `out_dir`. Needs pyside6-uic.
+    """
+    for src in sorted(os.listdir(UI_DIR)):
+        if src.endswith(".ui"):
+            _generate_ui(os.path.join(UI_DIR, src), out_dir)
+
+
+def _ui_module_name(path):
+    with open(path, "rb") as f:
+        digest = hashlib.sha1(f.read()).hexdigest()[:16]
+    name = os.path.splitext(os.path.basename(path))[0]
+    return f"{name}_{digest}"
+
+
+def _ui_cache_dir():
+    cache = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache, "folderme", "ui")
+
+
+def _load_compiled_ui(path):
+    """
+    Returns the (form, Qt class) pair for the form at `path` from its compiled
+    module, generating it if needed; or None if that is not possible.
+    """
+    module = _ui_module_name(path)
+    for d in (UI_COMPILED_DIR, _ui_cache_dir()):
+        compiled = os.path.join(d, f"{module}.py")
+        if os.path.isfile(compiled):
+            break
+    else:
+        try:
+            compiled = _generate_ui(path, _ui_cache_dir())
+        except Exception as e:
+            print(f"Cannot compile {path}, loading it at runtime: {e}")
+            return None
+        if not compiled:
+            return None
+
+    spec = importlib.util.spec_from_file_location(f"ui_{module}", compiled)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod.FORM, getattr(QtWidgets, mod.QT_CLASS)
+
+
+def _generate_ui(path, out_dir):
+    """
+    Runs pyside6-uic on the form at `path`, writing the module to `out_dir` and
+    removing older versions of it. Returns the module path, or None if the tool is
+    not available.
+    """
+    uic = shutil.which("pyside6-uic")
+    if not uic:
+        return None
+
+    code = subprocess.run(
+        [uic, path], check=True, capture_output=True, text=True
+    ).stdout
+    with open(path, encoding="utf-8") as f:
+        root = _UI_ROOT_RE.search(f.read()).group(1)
+    form = _UI_FORM_RE.search(code).group(1)
+    code += f"\n\nFORM = {form}\nQT_CLASS = {root!r}\n"
+
+    os.makedirs(out_dir, exist_ok=True)
+    module = _ui_module_name(path)
+    prefix = module.rsplit("_", 1)[0] + "_"
+    for f in os.listdir(out_dir):
+        if f.startswith(prefix) and f.endswith(".py") and f != f"{module}.py":
+            if re.fullmatch(r"[0-9a-f]{16}\.py", f[len(prefix) :]):
+                os.unlink(os.path.join(out_dir, f))
+
+    out = os.path.join(out_dir, f"{module}.py")
+    atomic_write(out, code)
+    return out
+
+
 def restore_ui(widget, name):
     data = SETTINGS.value(f"{name}/geometry")
     if data:
@@ -214,6 +701,19 @@ def config_dir(create=False):
     return path
 
 
+def atomic_write(path, data):
+    """
+    Replaces the contents of the file at `path`, so that a crash never leaves it
+    partially written.
+    """
+    tmp = f"{path}.tmp"
+    with open(tmp, "wt", encoding="utf-8") as out:
+        out.write(data)
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(tmp, path)
+
+
 def icon(name):
     return os.path.join(os.path.dirname(__file__), "icons", name)
 
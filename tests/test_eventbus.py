@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# Checks the delivery order of events sent while other events are being delivered,
+# and the coalescing of pending events.
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import util
+
+
+class Recorder(util.Listener):
+    def __init__(self, name, log, chain=None):
+        self.name = name
+        self.log = log
+        self.chain = chain or {}
+
+    def _record(self, event, *args):
+        self.log.append((self.name, event) + args)
+        for handler, handler_args in self.chain.get(event, ()):
+            util.EventBus.send(handler, *handler_args)
+
+    def playlist_changed(self):
+        self._record("playlist_changed")
+
+    def track_changed(self, track):
+        self._record("track_changed", track)
+
+    def track_playing(self, track):
+        self._record("track_playing", track)
+
+    def track_ended(self, track):
+        self._record("track_ended", track)
+
+
+class EventBusTest(unittest.TestCase):
+    def setUp(self):
+        self.log = []
+        self.listeners = []
+
+    def tearDown(self):
+        for l in self.listeners:
+            util.EventBus.remove(l)
+        util.EventBus.QUEUE.clear()
+
+    def add(self, name, chain=None):
+        l = Recorder(name, self.log, chain)
+        self.listeners.append(l)
+        util.EventBus.add(l)
+
+    def test_nested_chain(self):
+        # Events sent by a handler wait until the current event reached everyone.
+        self.add(
+            "a",
+            {
+                "track_ended": [(util.Listener.track_changed, ("t2",))],
+                "track_changed": [(util.Listener.track_playing, ("t2",))],
+            },
+        )
+        self.add("b", {"track_ended": [(util.Listener.playlist_changed, ())]})
+
+        util.EventBus.send(util.Listener.track_ended, "t1")
+
+        self.assertEqual(
+            self.log,
+            [
+                ("a", "track_ended", "t1"),
+                ("b", "track_ended", "t1"),
+                ("a", "track_changed", "t2"),
+                ("b", "track_changed", "t2"),
+                ("a", "playlist_changed"),
+                ("b", "playlist_changed"),
+                ("a", "track_playing", "t2"),
+                ("b", "track_playing", "t2"),
+            ],
+        )
+        self.assertFalse(util.EventBus.FIRING)
+
+    def test_batch(self):
+        self.add("a")
+
+        with util.EventBus.batch():
+            util.EventBus.send(util.Listener.track_ended, "t1")
+            util.EventBus.send(util.Listener.track_changed, "t2")
+            self.assertEqual(self.log, [])
+
+        self.assertEqual(
+            self.log, [("a", "track_ended", "t1"), ("a", "track_changed", "t2")]
+        )
+
+    def test_coalesce(self):
+        # The playlist_changed sent by "a" is still pending when "b" sends another
+        # one, so it is delivered once, after the track_changed sent in between.
+        self.add(
+            "a",
+            {
+                "track_ended": [
+                    (util.Listener.playlist_changed, ()),
+                    (util.Listener.track_changed, ("t2",)),
+                ]
+            },
+        )
+        self.add("b", {"track_ended": [(util.Listener.playlist_changed, ())]})
+
+        util.EventBus.send(util.Listener.track_ended, "t1")
+
+        self.assertEqual(
+            self.log,
+            [
+                ("a", "track_ended", "t1"),
+                ("b", "track_ended", "t1"),
+                ("a", "track_changed", "t2"),
+                ("b", "track_changed", "t2"),
+                ("a", "playlist_changed"),
+                ("b", "playlist_changed"),
+            ],
+        )
+
+    def test_coalesce_only_listed_events(self):
+        self.add("a")
+
+        with util.EventBus.batch():
+            util.EventBus.send(util.Listener.playlist_changed)
+            util.EventBus.send(util.Listener.track_changed, "t1")
+            util.EventBus.send(util.Listener.track_changed, "t2")
+            util.EventBus.send(util.Listener.playlist_changed)
+
+        self.assertEqual(
+            self.log,
+            [
+                ("a", "track_changed", "t1"),
+                ("a", "track_changed", "t2"),
+                ("a", "playlist_changed"),
+            ],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
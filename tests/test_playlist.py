@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# Checks that playlist changes that affect which tracks will play are announced, so
+# that listeners such as the MPRIS track list and the prefetcher stay current.
+import os
+import sys
+import tempfile
+import types
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import util
+
+MISSING = None
+try:
+    import app
+    import playlist
+except ImportError as e:
+    playlist = None
+    MISSING = str(e)
+
+
+def make_album(tracks=4):
+    infos = [
+        types.SimpleNamespace(path=f"/music/album/{i}.mp3", skip=False)
+        for i in range(tracks)
+    ]
+    return types.SimpleNamespace(
+        path="/music/album",
+        tracks=[playlist.Track(info, i) for i, info in enumerate(infos)],
+    )
+
+
+class Recorder(util.Listener):
+    def __init__(self):
+        self.changes = 0
+
+    def playlist_changed(self):
+        self.changes += 1
+
+
+@unittest.skipIf(playlist is None, f"player dependencies missing: {MISSING}")
+class PlaylistEventsTest(unittest.TestCase):
+    def setUp(self):
+        self.save_enabled = util.ConfigObj.SAVE_ENABLED
+        util.ConfigObj.SAVE_ENABLED = False
+        self.collection = mock.Mock()
+        patcher = mock.patch.object(
+            app, "get", return_value=types.SimpleNamespace(collection=self.collection)
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        album = make_album()
+        self.playlist = playlist.Playlist()
+        self.playlist.albums = [album]
+        self.tracks = album.tracks
+
+        self.recorder = Recorder()
+        util.EventBus.add(self.recorder)
+
+    def tearDown(self):
+        util.EventBus.remove(self.recorder)
+        util.EventBus.remove(self.playlist)
+        util.ConfigObj.SAVE_ENABLED = self.save_enabled
+
+    def test_set_skip(self):
+        self.playlist.set_skip(self.tracks[1], True)
+
+        self.assertEqual(self.recorder.changes, 1)
+        self.assertIs(self.playlist._peek_next(), self.tracks[2].info)
+
+    def test_toggle_kill(self):
+        self.playlist.toggle_kill([self.tracks[1], self.tracks[2]])
+
+        self.assertTrue(self.tracks[1].info.skip)
+        self.assertTrue(self.tracks[2].info.skip)
+        self.assertEqual(self.recorder.changes, 1)
+        self.collection.save.assert_called_once()
+        self.assertIs(self.playlist._peek_next(), self.tracks[3].info)
+
+        self.playlist.toggle_kill([self.tracks[1]])
+
+        self.assertFalse(self.tracks[1].info.skip)
+        self.assertEqual(self.recorder.changes, 2)
+        self.assertIs(self.playlist._peek_next(), self.tracks[1].info)
+
+
+@unittest.skipIf(playlist is None, f"player dependencies missing: {MISSING}")
+class PlaylistJournalTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        patcher = mock.patch.dict(os.environ, {"FOLDERME_CONFIG": tmp.name})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def load(self, generation):
+        p = playlist.Playlist()
+        self.addCleanup(util.EventBus.remove, p)
+        p.albums = [make_album()]
+        p.generation = generation
+        return p
+
+    def test_stop_after_cleared_when_track_ends(self):
+        p = self.load(None)
+        p._player = mock.Mock()
+        p._player.is_handing_off.return_value = True
+        p.stop_after(p.albums[0].tracks[0])
+
+        p.track_ended(p.albums[0].tracks[0].info)
+
+        # Replaying after a crash must not stop after the same track again.
+        replayed = self.load(p.generation)
+        replayed.albums[0].tracks[0].stop_after = True
+        self.assertTrue(replayed._replay())
+        self.assertFalse(replayed.albums[0].tracks[0].stop_after)
+        self.assertEqual(replayed.track_idx, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()